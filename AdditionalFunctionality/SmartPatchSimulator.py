@@ -9,25 +9,23 @@
 __docformat__ = 'google'
 
 # import libraries
+import json
 import time
-from random import randint
+import numpy as np
 import paho.mqtt.client as paho
 
+# random number generator for the simulated sensor values
+rng = np.random.default_rng()
 
-# generates random_integer between 0 and 100 every second
-def generate_random_int(lower_bound=0, upper_bound=100):
-    """Returns a random integer between two configurable bounds.
-       Per default, it is between 0 and 100.
+# simulated telemetry keys with their lowest and highest (exclusive) possible values
+TELEMETRY_KEYS = ('heartrate', 'bloodOxygenation', 'respirationRate', 'temperature', 'activityLevel',
+                  'batteryPercentage')
+LOWER_BOUNDS = np.array([40, 20, 0, 1, 1, 0])
+UPPER_BOUNDS = np.array([201, 101, 101, 41, 6, 101])
 
-    Args:
-      lower_bound(int, optional): lowest possible generated number. (Default value = 0)
-      upper_bound(int, optional): highest possible generated number. (Default value = 100)
-
-    Returns:
-      int: random number between lower_bound and upper_bound
-
-    """
-    return randint(lower_bound, upper_bound)
+# template for one datapoint, copied and filled with fresh random values every tick
+DATA_TEMPLATE = {'heartrate': 0, 'bloodOxygenation': 0, 'respirationRate': 0, 'temperature': 0,
+                 'activityLevel': 0, 'batteryPercentage': 0, 'firmwareVersion': '1.0.0'}
 
 
 # Access input_data for thingsboard server
@@ -35,6 +33,9 @@ ACCESS_TOKEN = 'AddYourOwnDeviceToken'  # Token of the Thingsboard device you wa
 BROKER = 'AddYourOwnIPAddress'  # host name
 PORT = 1883
 
+# number of datapoints that are collected before they are published in a single MQTT message
+BATCH_SIZE = 10
+
 
 # main loop
 def simulate(access_token, topic='v1/devices/me/telemetry', publishing_frequency=1,
@@ -52,25 +53,42 @@ def simulate(access_token, topic='v1/devices/me/telemetry', publishing_frequency
 
     """
     print(f"Starting SmartPatch Simulator with connected Patient:\n{access_token}")
-    while True:
-        # dict with random sensor input_data
-        random_data = {'heartrate': generate_random_int(40, 200), 'bloodOxygenation': generate_random_int(20, 100),
-                       'respirationRate': generate_random_int(),
-                       'temperature': generate_random_int(1, 40), 'activityLevel': generate_random_int(1, 5),
-                       'batteryPercentage': generate_random_int(), 'firmwareVersion': '1.0.0'}
-
-        # initializing mqtt client
-
-        client = paho.Client()  # create client object
-        client.username_pw_set(access_token)  # access token from Thingsboard device
-        client.connect(broker, port, keepalive=60)  # establish connection
-
-        # publishing to Thingsboard server
-        response = client.publish(topic, str(random_data))
-        response.wait_for_publish()
 
-        # wait before next publish
-        time.sleep(1/publishing_frequency)
+    # initializing mqtt client once, the connection is reused for all publishes
+    client = paho.Client()  # create client object
+    client.username_pw_set(access_token)  # access token from Thingsboard device
+    client.reconnect_delay_set(min_delay=1, max_delay=32)  # reconnect automatically if the connection drops
+    client.connect(broker, port, keepalive=60)  # establish connection
+    client.loop_start()  # network traffic is handled by a background thread
+
+    try:
+        # datapoints are collected here until a full batch can be published
+        datapoint_batch = []
+
+        # schedule datapoints against a monotonic deadline so publish latency does not slow down the sampling rate
+        period = 1 / publishing_frequency
+        next_deadline = time.monotonic()
+        while True:
+            # dict with random sensor input_data, all values are drawn with a single generator call
+            random_values = rng.integers(LOWER_BOUNDS, UPPER_BOUNDS)
+            random_data = DATA_TEMPLATE.copy()
+            random_data.update(zip(TELEMETRY_KEYS, random_values.tolist()))
+            datapoint_batch.append({'ts': int(time.time() * 1000), 'values': random_data})
+
+            # publishing a whole batch to Thingsboard server, fire-and-forget since simulated input_data is disposable
+            if len(datapoint_batch) == BATCH_SIZE:
+                client.publish(topic, json.dumps(datapoint_batch), qos=0)
+                datapoint_batch = []
+
+            # wait until the next deadline, skipping the sleep if publishing took longer than one period
+            next_deadline += period
+            delay = next_deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        # clean up the connection when the simulation stops
+        client.loop_stop()
+        client.disconnect()
 
 
 # run script
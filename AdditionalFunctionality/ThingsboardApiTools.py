@@ -9,13 +9,26 @@ Further methods are implemented, for example methods to get telemetry input_data
 __docformat__ = 'google'
 
 # import libraries
+import csv
+import json
 import logging
-import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter, Retry
 from tb_rest_client.rest import ApiException
 from tb_rest_client.rest_client_ce import *
+# the star import above re-exports time.time under the name time, restore the module
+import time
 
-# logging configuration
-logging.basicConfig(level=logging.DEBUG)
+# module logger, the level is left to the application and can be set via the log_level argument of ApiTools
+logger = logging.getLogger(__name__)
+
+# silence the per-request debug lines of the HTTP layer
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+
+# how long a cached device id dict stays valid, in seconds
+DEVICE_ID_CACHE_TTL = 60
 
 
 class ApiTools:
@@ -30,7 +43,7 @@ class ApiTools:
     password: str
     """""Password on chosen thingsboard server."""
 
-    def __init__(self, api_url, username='tenant@thingsboard.org', password='tenant'):
+    def __init__(self, api_url, username='tenant@thingsboard.org', password='tenant', log_level=None):
         """
         Initiate tool with the parameters to access the Thingsboard API.
 
@@ -38,22 +51,51 @@ class ApiTools:
             api_url(str, optional): url of chosen thingsboard server
             username(str, optional): username on chosen thingsboard server (Default value = 'tenant@thingsboard.org')
             password(str, optional): password on chosen thingsboard server (Default value = 'tenant')
+            log_level(int, optional): logging level for this module, for example logging.INFO (Default value = None)
 
         """
         self.username = username
         self.password = password
         self.url = api_url
 
+        if log_level is not None:
+            logger.setLevel(log_level)
+
+        # Creating one long-lived REST client, started manually to get auto token refresh
+        self.rest_client = RestClientCE(base_url=self.url)
+        self.rest_client.start()
+        self.login()
+
+        # cached result of get_device_id_dict with the time it was fetched
+        self.device_id_cache = None
+        self.device_id_cache_ts = 0.0
+
+        # shared HTTP session with a connection pool for bulk telemetry uploads
+        self.http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32,
+                              max_retries=Retry(total=3, backoff_factor=0.2))
+        self.http_session.mount('http://', adapter)
+        self.http_session.mount('https://', adapter)
+
     # login to REST API
     def login(self):
         """Log into Thingsboard api."""
-        # Creating the REST client object with context manager to get auto token refresh
-        with RestClientCE(base_url=self.url) as rest_client:
-            try:
-                # Auth with credentials
-                rest_client.login(username=self.username, password=self.password)
-            except ApiException as e:
-                logging.exception(e)
+        try:
+            # Auth with credentials
+            self.rest_client.login(username=self.username, password=self.password)
+        except ApiException as e:
+            logger.exception(e)
+
+    def close(self):
+        """Stop the long-lived REST client and close the HTTP session."""
+        self.rest_client.stop()
+        self.http_session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def add_device(self, device_name, device_type):
         """Add a new device with device_name from entity_type to the Thingsboard database.
@@ -63,15 +105,13 @@ class ApiTools:
           device_type(str): type of device in Thingsboard database
 
         """
-        with RestClientCE(base_url=self.url) as rest_client:
-            try:
-                # Auth with credentials
-                rest_client.login(username=self.username, password=self.password)
-                # Creating Device
-                new_device = Device(name=device_name, type=device_type)
-                rest_client.save_device(new_device)
-            except ApiException as e:
-                logging.exception(e)
+        try:
+            # Creating Device
+            new_device = Device(name=device_name, type=device_type)
+            self.rest_client.save_device(new_device)
+            self.device_id_cache = None  # the cached device ids are outdated now
+        except ApiException as e:
+            logger.exception(e)
 
     def add_asset(self, asset_name, asset_type):
         """Add a new asset with asset_name from asset_type to the Thingsboard database.
@@ -81,15 +121,12 @@ class ApiTools:
           asset_type(str): type of asset in Thingsboard database
 
         """
-        with RestClientCE(base_url=self.url) as rest_client:
-            try:
-                # Auth with credentials
-                rest_client.login(username=self.username, password=self.password)
-                # Creating Asset
-                new_asset = Asset(name=asset_name, type=asset_type)
-                rest_client.save_asset(new_asset)
-            except ApiException as e:
-                logging.exception(e)
+        try:
+            # Creating Asset
+            new_asset = Asset(name=asset_name, type=asset_type)
+            self.rest_client.save_asset(new_asset)
+        except ApiException as e:
+            logger.exception(e)
 
     def add_customer(self, customer_name, customer_title):
         """Add a new customer with customer_name and customer_title to the Thingsboard database.
@@ -99,35 +136,37 @@ class ApiTools:
           customer_title(st): title of customer in Thingsboard database
 
         """
-        with RestClientCE(base_url=self.url) as rest_client:
-            try:
-                # Auth with credentials
-                rest_client.login(username=self.username, password=self.password)
-                # Creating Customer
-                new_customer = Customer(name=customer_name, title=customer_title)
-                rest_client.save_customer(new_customer)
-            except ApiException as e:
-                logging.exception(e)
-
-    def add_entity_list(self, entity_list, device_type):
+        try:
+            # Creating Customer
+            new_customer = Customer(name=customer_name, title=customer_title)
+            self.rest_client.save_customer(new_customer)
+        except ApiException as e:
+            logger.exception(e)
+
+    def add_entity_list(self, entity_list, device_type, max_workers=16):
         """Add entities provided in entity_list to Thingsboard database.
 
+        The entities are saved concurrently from a bounded thread pool since every save is a blocking HTTP request.
+
         Args:
           entity_list(list: list): list of names of all entities that will be added
           device_type(str): type of entities that will be added.
+          max_workers(int, optional): number of concurrent save requests (Default value = 16)
 
         """
 
-        with RestClientCE(self.url) as rest_client:
-            try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.rest_client.save_device,
+                                       Device(name=entity_name, type=device_type),
+                                       access_token=entity_name)
+                       for entity_name in entity_list]
 
-                rest_client.login(self.username, self.password)
-                for entity_name in entity_list:
-                    entity = Device(name=entity_name, type=device_type)
-                    rest_client.save_device(entity, access_token=entity_name)
+        # log failed saves without aborting the rest of the batch
+        for future in futures:
+            if future.exception() is not None:
+                logger.error('saving device failed', exc_info=future.exception())
 
-            except ApiException as e:
-                logging.exception(e)
+        self.device_id_cache = None  # the cached device ids are outdated now
 
     def add_entity_csv(self, file_path, entity_type, chosen_delimiter=';'):
         """Add a list of entities from a csv file to Thingsboard database.
@@ -142,39 +181,63 @@ class ApiTools:
 
         """
 
-        file_reader = np.loadtxt(file_path, dtype='str', delimiter=chosen_delimiter)
-        entity_list = list(file_reader)
+        with open(file_path, newline='') as entity_file:
+            file_reader = csv.reader(entity_file, delimiter=chosen_delimiter)
+            entity_list = [row[0] for row in file_reader if row]
 
         if entity_type == 'Raw':
             entity_list = [entity + ' Raw Data' for entity in entity_list]
 
         self.add_entity_list(entity_list=entity_list, device_type=entity_type)
 
-    def get_device_id_dict(self, max_devices=100):
+    def get_device_id_dict(self, page_size=100):
         """Return a dict with device names as keys and Thingsboard device ids as values.
         
-        Fetch up to max_devices with type Patient from Thingsboard database. For every Patient
+        Fetch all devices with type Patient from Thingsboard database, page by page. For every Patient
         the Thingsboard device id is added as value. This id can be used to access the Thingsboard
         device with their API.
 
+        The fetched dict is cached for DEVICE_ID_CACHE_TTL seconds so repeated lookups do not
+        trigger a full REST fetch each time. The cache is invalidated when devices are added.
+
         Args:
-          max_devices(int, optional): maximum number of devices that will be fetched (Default value = 100)
+          page_size(int, optional): number of devices fetched per page (Default value = 100)
 
         Returns:
           dict: dict with device names as keys and device ids as values:
 
         """
+        if self.device_id_cache is not None and time.monotonic() - self.device_id_cache_ts < DEVICE_ID_CACHE_TTL:
+            return self.device_id_cache
+
         device_id_dict = {}
-        with RestClientCE(self.url) as rest_client:
+        fetched = False
+        for attempt in range(2):
             try:
-                rest_client.login(self.username, self.password)
-                message = rest_client.get_tenant_device_infos(page_size=str(max_devices), page='0',
-                                                              type='Patient')
-                for current_device in message.data:
-                    device_id_dict[current_device.name] = current_device.id.id
+                page = 0
+                while True:
+                    message = self.rest_client.get_tenant_device_infos(page_size=str(page_size), page=str(page),
+                                                                       type='Patient')
+                    for current_device in message.data:
+                        device_id_dict[current_device.name] = current_device.id.id
+                    if not message.has_next:
+                        break
+                    page += 1
+                fetched = True
+                break
 
             except ApiException as e:
-                logging.exception(e)
+                if attempt == 0:
+                    # the session token may have expired, log in again and retry once
+                    device_id_dict = {}
+                    self.login()
+                else:
+                    logger.exception(e)
+
+        # only cache complete fetches, otherwise a transient outage would be served for a full TTL
+        if fetched:
+            self.device_id_cache = device_id_dict
+            self.device_id_cache_ts = time.monotonic()
         return device_id_dict
 
     def get_device_id(self, device_name):
@@ -187,14 +250,13 @@ class ApiTools:
           str: the Thingsboard device id
 
         """
-        device_id_dict = self.get_device_id_dict()
-        if device_name in device_id_dict:
-            return device_id_dict[device_name]
-        else:
+        device_id = self.get_device_id_dict().get(device_name)
+        if device_id is None:
             return f'{device_name} is not in database. '
+        return device_id
 
     # noinspection PyTypeChecker
-    def get_telemetry(self, thingsboard_device_id, key, start_ts_ms, end_ts_ms):
+    def get_telemetry(self, thingsboard_device_id, key, start_ts_ms, end_ts_ms, limit=100, agg=None, interval=None):
         """Return telemetry input_data as array of input_data points for given device in between start_ts_ms and
            end_ts_ms.
         
@@ -202,28 +264,63 @@ class ApiTools:
         That is not the usual way python provides timestamps.
         To get start_ts_ms and end_ts_ms you can use get get_ts_ms to convert a default time.time() timestamp.
 
+        The number of returned datapoints is bounded by limit so wide time ranges do not pull every raw
+        point over the wire. Pass limit=1 to only fetch the latest sample.
+
         Args:
           thingsboard_device_id(str): id for device from Thingsboard database
           key(str): telemetry key from Thingsboard database that is accessed
           start_ts_ms(int): fetch telemetry input_data after this timestamp
           end_ts_ms(int): fetch telemetry input_data up to this timestamp
+          limit(int, optional): maximum number of datapoints that will be fetched (Default value = 100)
+          agg(str, optional): server-side aggregation function, for example 'AVG' (Default value = None)
+          interval(int, optional): aggregation interval in milliseconds (Default value = None)
 
         """
-        with RestClientCE(self.url) as rest_client:
-            try:
-                rest_client.login(self.username, self.password)
-                data = rest_client.get_timeseries(entity_type='DEVICE',
-                                                  entity_id=thingsboard_device_id,
-                                                  keys=key,
-                                                  start_ts=str(start_ts_ms),
-                                                  end_ts=str(end_ts_ms))
-                if data:
-                    return data[key]
-                else:
-                    return 'No input_data found'
+        try:
+            data = self.rest_client.get_timeseries(entity_type='DEVICE',
+                                                   entity_id=thingsboard_device_id,
+                                                   keys=key,
+                                                   start_ts=str(start_ts_ms),
+                                                   end_ts=str(end_ts_ms),
+                                                   limit=str(limit),
+                                                   agg=agg,
+                                                   interval=interval)
+            if data:
+                return data[key]
+            else:
+                return 'No input_data found'
+
+        except ApiException as e:
+            logger.exception(e)
+
+    def save_telemetry_batch(self, device_token, samples, chunk_size=500, max_workers=8):
+        """Upload a batch of telemetry samples for one device over HTTP.
+        
+        The samples are posted in chunks of chunk_size datapoints, pipelined through a thread pool
+        over the shared keep-alive HTTP session. Useful for backfills and simulator-driven tests
+        where publishing datapoints one by one would be bounded by round-trips.
 
-            except ApiException as e:
-                logging.exception(e)
+        Args:
+          device_token(str): access token of the Thingsboard device that receives the telemetry
+          samples(list): datapoints in Thingsboard format, {'ts': timestamp_in_ms, 'values': dict_of_values}
+          chunk_size(int, optional): number of samples per POST request (Default value = 500)
+          max_workers(int, optional): number of concurrent POST requests (Default value = 8)
+
+        """
+        telemetry_url = f'{self.url}/api/v1/{device_token}/telemetry'
+        headers = {'Content-Type': 'application/json'}
+        chunks = [samples[index:index + chunk_size] for index in range(0, len(samples), chunk_size)]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.http_session.post, telemetry_url,
+                                       data=json.dumps(chunk), headers=headers)
+                       for chunk in chunks]
+
+        # log failed uploads without aborting the rest of the batch
+        for future in futures:
+            if future.exception() is not None:
+                logger.error('telemetry upload failed', exc_info=future.exception())
 
     @staticmethod
     def get_ts_ms(timestamp):
@@ -246,11 +343,9 @@ class ApiTools:
           home_dashboard_id(DashboardId): object, only accessible via the Thingsboard API
 
         """
-        with RestClientCE(self.url) as rest_client:
-            try:
-                rest_client.login(self.username, self.password)
-                rest_client.set_tenant_home_dashboard_info(body=HomeDashboardInfo(home_dashboard_id,
-                                                                                  hide_dashboard_toolbar=False))
+        try:
+            self.rest_client.set_tenant_home_dashboard_info(body=HomeDashboardInfo(home_dashboard_id,
+                                                                                   hide_dashboard_toolbar=False))
 
-            except ApiException as e:
-                logging.exception(e)
+        except ApiException as e:
+            logger.exception(e)
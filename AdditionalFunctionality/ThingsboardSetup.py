@@ -30,16 +30,16 @@ def thingsboard_initial_setup(basestation_file_path=BASESTATION_FILE_PATH
 
     """
 
-    # start tool with default values
-    tool = ThingsboardApiTools.ApiTools(api_url='http://' + IP_ADDRESS + ':8080')
+    # start tool with default values, closed on exit so the REST client's refresh thread stops
+    with ThingsboardApiTools.ApiTools(api_url='http://' + IP_ADDRESS + ':8080') as tool:
 
-    # add basestation devices
-    tool.add_entity_csv(file_path=basestation_file_path, entity_type='Basestation')
+        # add basestation devices
+        tool.add_entity_csv(file_path=basestation_file_path, entity_type='Basestation')
 
-    # add patients from list initial patients list
-    tool.add_entity_csv(file_path=patient_file_path, entity_type='Patient')
-    # add second device for raw data logging for every patient
-    tool.add_entity_csv(file_path=patient_file_path, entity_type='Raw')
+        # add patients from list initial patients list
+        tool.add_entity_csv(file_path=patient_file_path, entity_type='Patient')
+        # add second device for raw data logging for every patient
+        tool.add_entity_csv(file_path=patient_file_path, entity_type='Raw')
 
 
 # run script
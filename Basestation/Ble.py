@@ -11,6 +11,9 @@ __docformat__ = 'google'
 import asyncio
 import logging
 import time
+from collections import deque
+
+import numpy as np
 
 import bleak.exc
 from bleak import BleakClient
@@ -53,14 +56,16 @@ async def test_function():
     # add device
     with Globals.mac_address_update_lock:
         for address in test_addresses:
-            Globals.mac_address_update[address] = 'add'
+            Globals.pending_adds.append(address)
+    Globals.add_request_event.set()
 
     await asyncio.sleep(120)
 
     # remove device
     with Globals.mac_address_update_lock:
         for address in test_addresses:
-            Globals.mac_address_update[address] = 'remove'
+            Globals.pending_removes.add(address)
+    Globals.remove_request_event.set()
 
     # measure throughput
     throughput_test()
@@ -76,26 +81,31 @@ def throughput_test(test_val_arg=None):
             test_val_arg(dict, optional): a dictionary with the expected values for each characteristic
         Returns:
         """
-    with Globals.unprocessed_data_lock:
-        total_throughput = 0
-        for address in Globals.unprocessed_data:
-            error_cnt = 0
-            bytes_cnt = 0
-            start = Globals.unprocessed_data[address][0]['ts']
-            end = Globals.unprocessed_data[address][-1]['ts']
-
-            for datapoint in Globals.unprocessed_data[address]:
-                for char, val in datapoint['values'].items():
-                    bytes_cnt = bytes_cnt + len(val) * bytes_per_int[char]
-                    if test_val_arg and val != test_val_arg[char]:
-                        print(f"{char} received value: {val}\n expected value: {test_val_arg[char]}")
-                        error_cnt = error_cnt + 1
-
-            throughput = (bytes_cnt * 8 * (1000 / (end - start))) / 1000
-            total_throughput = total_throughput + throughput
-            print(f"{address}: {error_cnt} errors,"
-                  f"received {bytes_cnt} bytes in {end - start} ms --> {throughput:.2f} kbit/s")
-        print(f"total throughput: {total_throughput:.2f} kbit/s")
+    total_throughput = 0
+    for address in list(Globals.bytes_received):
+        # the running counters make this an O(1) read per device instead of a scan of all buffers
+        with Globals.unprocessed_data_locks[address]:
+            bytes_cnt = Globals.bytes_received[address]
+            start = Globals.first_timestamp.get(address)
+            end = Globals.last_timestamp.get(address)
+
+        # optional correctness check, only this path still scans the raw notification buffers
+        error_cnt = 0
+        if test_val_arg:
+            with Globals.unprocessed_data_locks[address]:
+                for char, samples in Globals.unprocessed_data.get(address, {}).items():
+                    for _, val in samples:
+                        if val != test_val_arg[char]:
+                            print(f"{char} received value: {val}\n expected value: {test_val_arg[char]}")
+                            error_cnt = error_cnt + 1
+
+        if start is None or end is None or end == start:
+            continue
+        throughput = (bytes_cnt * 8 * (1000 / (end - start))) / 1000
+        total_throughput = total_throughput + throughput
+        print(f"{address}: {error_cnt} errors,"
+              f"received {bytes_cnt} bytes in {end - start} ms --> {throughput:.2f} kbit/s")
+    print(f"total throughput: {total_throughput:.2f} kbit/s")
 
 
 # **********************************************************************************************************************
@@ -110,43 +120,53 @@ rw_handles = {'version': 36, 'config': 38}
 # bytes per value
 bytes_per_int = {'imu': 2, 'audio': 2, 'ppg': 4, 'temperature': 4, 'voltage': 4, 'current': 4}
 
+# little-endian numpy dtype per characteristic, only ppg and imu send signed values
+data_dtypes = {'imu': '<i2', 'audio': '<u2', 'ppg': '<i4', 'temperature': '<u4', 'voltage': '<u4', 'current': '<u4'}
 
-# get the first key with the given value
-def get_key_from_value(d, val):
-    """Get a key with the given value from a dict.
-       Useful for getting the mac addresses from the update dict.
-        Args:
-            d(dict): dictionary
-            val: value
-        Returns:
-            key: key with the given value
-        """
-    keys = [k for k, v in d.items() if v == val]
-    return keys[0]
+# combined descriptor table so the notification callback resolves name and dtype with one lookup
+char_info = {handle: (char, data_dtypes[char]) for handle, char in notify_handles.items()}
+
+# notifications are buffered per connection and flushed in batches into the shared buffers
+notification_batch_size = 16
+notification_flush_interval = 0.05
 
 
 # convert bytearray to int array
 def convert_data(char, data):
     """Convert bytearray from notification to integer list.
+       The whole payload is decoded with one vectorized numpy call instead of a Python loop.
         Args:
             char(str): characteristic which sent the notification
             data(bytearray): input_data to be converted
         Returns:
             list: list with the converted input_data
         """
-    signed = False
-    if (char == 'ppg') or (char == 'imu'):
-        signed = True
-    step = bytes_per_int[char]
-    converted_data = [0] * int(len(data) / step)
-    for index in range(len(converted_data)):
-        if signed:
-            converted_data[index] = int.from_bytes(bytes=data[step * index:step * (index + 1)], byteorder='little',
-                                                   signed=True)
-        else:
-            converted_data[index] = int.from_bytes(bytes=data[step * index:step * (index + 1)], byteorder='little',
-                                                   signed=False)
-    return converted_data
+    # frombuffer reinterprets the bytearray from bleak in place, tolist() copies before bleak reuses it
+    return np.frombuffer(data, dtype=data_dtypes[char]).tolist()
+
+
+# wake the connection tasks when a new connection request was queued
+def signal_connection_request():
+    """Wake the connection tasks waiting for a connection request.
+
+       Safe to call from any thread: the event is set on the BLE event loop via call_soon_threadsafe.
+       Calls made before the loop is running are harmless, `ble_loop` picks up requests queued
+       ahead of its start itself.
+        """
+    loop = Globals.ble_event_loop
+    if loop is not None:
+        loop.call_soon_threadsafe(Globals.add_request_event.set)
+
+
+# wake the invalid-remove-request check when a new disconnection request was queued
+def signal_remove_request():
+    """Wake the invalid-remove-request check after a disconnection request was queued.
+
+       Safe to call from any thread, see `signal_connection_request`.
+        """
+    loop = Globals.ble_event_loop
+    if loop is not None:
+        loop.call_soon_threadsafe(Globals.remove_request_event.set)
 
 
 # check if devices can be connected
@@ -157,12 +177,9 @@ async def search_connectable_devices():
             str: mac address of the SmartPatch if a connection request is found, 'None' otherwise
         """
     with Globals.mac_address_update_lock:
-        if 'add' in Globals.mac_address_update.values():
-            address = get_key_from_value(d=Globals.mac_address_update, val='add')
-            del Globals.mac_address_update[address]
-            return address
-        else:
-            return 'None'
+        if Globals.pending_adds:
+            return Globals.pending_adds.popleft()
+        return 'None'
 
 
 # check if device should be disconnected
@@ -175,12 +192,11 @@ async def search_remove_request(address):
             bool: True if a remove request is found, False otherwise
         """
     with Globals.mac_address_update_lock:
-        if address in Globals.mac_address_update.keys():
-            if Globals.mac_address_update[address] == 'remove':
-                return True
-            elif Globals.mac_address_update[address] == 'add':
-                logging.exception(f"device with address {address} is already connected")
-                del Globals.mac_address_update[address]
+        if address in Globals.pending_removes:
+            return True
+        if address in Globals.pending_adds:
+            logging.exception(f"device with address {address} is already connected")
+            Globals.pending_adds.remove(address)
     return False
 
 
@@ -192,12 +208,15 @@ async def disconnect(device, address):
             address(str): mac address of the device
         Returns:
         """
-    # stop notifications
-    for handle in notify_handles.keys():
-        try:
-            await device.stop_notify(char_specifier=handle)
-        except (KeyError, exc.BleakError):
-            logging.exception(f"{address} : {notify_handles[handle]} notifications could not be stopped")
+    # stop notifications concurrently, one dbus round-trip per characteristic would serialize here
+    results = await asyncio.gather(*(device.stop_notify(char_specifier=handle) for handle in notify_handles),
+                                   return_exceptions=True)
+    for handle, result in zip(notify_handles, results):
+        if isinstance(result, (KeyError, exc.BleakError)):
+            logging.error(f"{address} : {notify_handles[handle]} notifications could not be stopped",
+                          exc_info=result)
+        elif isinstance(result, BaseException):
+            raise result
 
     # disconnect
     try:
@@ -207,7 +226,7 @@ async def disconnect(device, address):
 
     # delete remove request
     with Globals.mac_address_update_lock:
-        del Globals.mac_address_update[address]
+        Globals.pending_removes.discard(address)
     print(f"Disconnected from SmartPatch with address {address}.")
 
 
@@ -219,14 +238,20 @@ async def invalid_remove_request_task():
         Returns:
         """
     while True:
+        # demand-driven: woken by a queued remove request instead of polling on an empty schedule
+        await Globals.remove_request_event.wait()
+
+        # grace period giving in-flight connections time to complete before a remove counts as invalid
         await asyncio.sleep(30)
         with Globals.mac_address_update_lock:
-            if 'remove' in Globals.mac_address_update.values():
-                address = get_key_from_value(d=Globals.mac_address_update, val='remove')
-                with Globals.connected_devices_lock:
-                    if address not in Globals.connected_devices.keys():
-                        logging.exception(f"invalid remove request from {address}")
-                        del Globals.mac_address_update[address]
+            with Globals.connected_devices_lock:
+                invalid_requests = [address for address in Globals.pending_removes
+                                    if address not in Globals.connected_devices]
+            for address in invalid_requests:
+                logging.exception(f"invalid remove request from {address}")
+                Globals.pending_removes.discard(address)
+            if not Globals.pending_removes:
+                Globals.remove_request_event.clear()
 
 
 # get firmware version and add as connected device
@@ -293,55 +318,118 @@ async def connection_task():
     # address initialization
     address = 'None'
 
+    # notifications buffered by the callback until the next flush, only touched on the event loop thread
+    pending = []
+
     # callback function
-    def callback(sender, data):
-        timestamp = round(time.time() * 1000)
-        char = notify_handles[sender]
-        converted_data = convert_data(char=char, data=data)
-        with Globals.unprocessed_data_lock:
-            if address not in Globals.unprocessed_data:
-                Globals.unprocessed_data[address] = [{'ts': timestamp, 'values': {char: converted_data}}]
-            else:
-                Globals.unprocessed_data[address].append({'ts': timestamp, 'values': {char: converted_data}})
-
-    # endless loop waiting for a change in the update dict
+    # hot-path globals are bound as default arguments so the callback resolves them as locals
+    def callback(sender, data, _ns=time.time_ns, _info=char_info, _frombuffer=np.frombuffer):
+        # integer division of the nanosecond clock is cheaper than the float multiply and round
+        # and keeps the wall-clock timestamps Thingsboard expects as telemetry ts
+        timestamp = _ns() // 1_000_000
+        # modern bleak passes the characteristic object; one lookup of its handle in the
+        # combined descriptor table yields both the name and the dtype
+        char, dtype = _info[sender.handle]
+        # frombuffer reinterprets the bytearray from bleak in place, tolist() copies before bleak reuses it
+        converted_data = _frombuffer(data, dtype=dtype).tolist()
+        # buffering without locking is safe since bleak runs the callback on the event loop thread
+        pending.append((timestamp, char, converted_data))
+        if len(pending) >= notification_batch_size:
+            flush_pending()
+
+    # move the buffered notifications into the shared buffers in one locked pass
+    def flush_pending():
+        """Flush the buffered notifications of this connection into `Globals.unprocessed_data`.
+
+           Batching the flush amortizes the lock acquisition and dict lookups over many notifications
+           instead of paying them once per notification.
+        """
+        if not pending:
+            return
+        # the per-address lock only serializes against consumers of the same device,
+        # notifications from other SmartPatches are never blocked here
+        with Globals.unprocessed_data_locks[address]:
+            # one deque per characteristic avoids allocating a nested dict per notification
+            per_char = Globals.unprocessed_data.setdefault(address, {})
+            for timestamp, char, converted_data in pending:
+                if char not in per_char:
+                    # the maxlen bounds memory if the consumer stalls, old notifications are dropped
+                    per_char[char] = deque(maxlen=Settings.MAX_BUFFERED_NOTIFICATIONS)
+                per_char[char].append((timestamp, converted_data))
+                # keep the running statistics so throughput_test does not have to scan the buffers
+                Globals.bytes_received[address] = (Globals.bytes_received.get(address, 0)
+                                                   + len(converted_data) * bytes_per_int[char])
+                Globals.last_timestamp[address] = timestamp
+            Globals.first_timestamp.setdefault(address, pending[0][0])
+        pending.clear()
+        # signal the main thread that SmartPatch input_data was received
+        Globals.unprocessed_data_ready.set()
+
+    # flush the buffer periodically so sparse characteristics are not held back by the batch size
+    async def flush_loop():
+        """Flush the notification buffer every `notification_flush_interval` seconds."""
+        while True:
+            await asyncio.sleep(notification_flush_interval)
+            flush_pending()
+
+    # endless loop waiting for connection requests
     while True:
 
+        # wait until a connection request is signaled instead of polling every 2 seconds
+        await Globals.add_request_event.wait()
+
         # check if devices can be connected
         address = await search_connectable_devices()
 
+        # clear the event once the pending requests are drained so the idle tasks stop waking up
+        with Globals.mac_address_update_lock:
+            if not Globals.pending_adds:
+                Globals.add_request_event.clear()
+
         # check if there is a valid device to connect
         if address != 'None':
             try:
-                async with BleakClient(address, device="hci0", timeout=60.0) as device:
+                async with BleakClient(address, adapter="hci0", timeout=60.0) as device:
                     if device.is_connected:
                         await add_connected(device=device, address=address)
 
-                    # start notifications
-                    for handle in notify_handles.keys():
-                        try:
-                            await device.start_notify(handle, callback)
-                        except (KeyError, exc.BleakError):
-                            logging.exception(
-                                f"{address} : {notify_handles[handle]} notifications could not be started")
-
-                    # run until device needs to be removed
-                    remove_request = False
-                    while device.is_connected and remove_request is False:
-                        await asyncio.sleep(1)
-                        remove_request = await search_remove_request(address=address)
-                        await search_config_update(device=device, address=address)
-
-                    # disconnect from device
-                    if device.is_connected:
-                        await disconnect(device=device, address=address)
+                    # start notifications concurrently instead of one dbus round-trip after the other
+                    results = await asyncio.gather(*(device.start_notify(handle, callback)
+                                                     for handle in notify_handles),
+                                                   return_exceptions=True)
+                    for handle, result in zip(notify_handles, results):
+                        if isinstance(result, (KeyError, exc.BleakError)):
+                            logging.error(
+                                f"{address} : {notify_handles[handle]} notifications could not be started",
+                                exc_info=result)
+                        elif isinstance(result, BaseException):
+                            raise result
+
+                    # flush buffered notifications while the device is connected
+                    flush_task = asyncio.create_task(flush_loop())
+
+                    try:
+                        # run until device needs to be removed
+                        remove_request = False
+                        while device.is_connected and remove_request is False:
+                            await asyncio.sleep(1)
+                            remove_request = await search_remove_request(address=address)
+                            await search_config_update(device=device, address=address)
+
+                        # disconnect from device
+                        if device.is_connected:
+                            await disconnect(device=device, address=address)
+                    finally:
+                        flush_task.cancel()
+                        flush_pending()
 
             # if there are many devices trying to connect simultaneously the traffic on the dbus can cause errors
             except exc.BleakDBusError:
                 logging.exception(f"{address}: DBus Error, trying to connect again later")
                 await asyncio.sleep(2)
                 with Globals.mac_address_update_lock:
-                    Globals.mac_address_update[address] = 'add'
+                    Globals.pending_adds.append(address)
+                Globals.add_request_event.set()
 
             except (asyncio.TimeoutError, exc.BleakError):
                 logging.exception(f"{address}: configuration error, device is not connectable")
@@ -349,9 +437,6 @@ async def connection_task():
             # reset address
             address = 'None'
 
-        # wait a while before searching connectable devices again
-        await asyncio.sleep(2)
-
 
 async def ble_loop():
     """
@@ -360,6 +445,14 @@ async def ble_loop():
        All threads are endless loops and run concurrently.
 
     """
+    # publish the running loop so other threads can wake the connection tasks
+    Globals.ble_event_loop = asyncio.get_running_loop()
+
+    # pick up connection requests that were queued before the loop started
+    with Globals.mac_address_update_lock:
+        if Globals.pending_adds:
+            Globals.add_request_event.set()
+
     if test_ble is True:
         await asyncio.gather(test_function(), invalid_remove_request_task(),
                              *(connection_task() for _ in range(Settings.DEVICE_MAXIMUM)))
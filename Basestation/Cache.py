@@ -0,0 +1,119 @@
+"""
+Small TTL cache for the results of Thingsboard REST fetches.
+
+Repeated configuration or mapping fetches within the TTL are answered from memory instead of
+issuing another HTTP round-trip. Incoming Thingsboard updates invalidate the matching cache,
+so a refresh after an update always hits the server.
+"""
+
+# setting the docstring format for the documentation
+__docformat__ = 'google'
+
+# import libraries
+import functools
+import threading
+import time
+from collections import deque
+
+
+class SimpleTTLCache:
+    """Thread-safe cache whose entries expire after a fixed time to live.
+
+    The oldest entry is evicted once max_size keys are stored, so the cache
+    stays bounded even if callers vary their arguments.
+    """
+
+    def __init__(self, ttl=300, max_size=128):
+        """Initialize an empty cache.
+
+        Args:
+          ttl(int, optional): seconds an entry stays valid (Default value = 300)
+          max_size(int, optional): maximum number of stored entries (Default value = 128)
+
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = {}  # key -> (expiry timestamp, value)
+        self.order = deque()  # keys in insertion order, oldest first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key or None if it is missing or expired.
+
+        Args:
+          key: hashable cache key
+
+        Returns:
+          the stored value or None
+
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expiry, value = entry
+            if time.time() >= expiry:
+                # drop the key from the insertion order too, a stale duplicate there would
+                # make the eviction in set() pop a live entry prematurely
+                del self.entries[key]
+                self.order.remove(key)
+                return None
+            return value
+
+    def set(self, key, value):
+        """Store value under key, evicting the oldest entry when the cache is full.
+
+        Args:
+          key: hashable cache key
+          value: value to store
+
+        """
+        with self.lock:
+            if key not in self.entries:
+                while len(self.order) >= self.max_size:
+                    self.entries.pop(self.order.popleft(), None)
+                self.order.append(key)
+            self.entries[key] = (time.time() + self.ttl, value)
+
+    def invalidate(self):
+        """Drop all cached entries."""
+        with self.lock:
+            self.entries.clear()
+            self.order.clear()
+
+
+def cached(ttl=300, max_size=128):
+    """Cache the decorated function's results in a SimpleTTLCache keyed by its arguments.
+
+    The cache is exposed as the `cache` attribute of the wrapper so callers can invalidate it,
+    and a `force_refresh=True` keyword argument bypasses the cache for one call. Empty results
+    are not cached, so a failed fetch is retried on the next call instead of being served
+    from memory for the whole TTL.
+
+    Args:
+      ttl(int, optional): seconds a result stays valid (Default value = 300)
+      max_size(int, optional): maximum number of stored results (Default value = 128)
+
+    Returns:
+      Callable: decorator wrapping the function with the cache
+
+    """
+    def decorator(func):
+        cache = SimpleTTLCache(ttl=ttl, max_size=max_size)
+
+        @functools.wraps(func)
+        def wrapper(*args, force_refresh=False, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            if not force_refresh:
+                value = cache.get(key)
+                if value is not None:
+                    return value
+            value = func(*args, **kwargs)
+            if value:
+                cache.set(key, value)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
@@ -1,9 +1,9 @@
 """
 Implementation of input_data processing algorithms.
 
-Take data from global dict `Globals.unprocessed_data` , process it and append it to `Globals.processed_data`.
+Take data from global dict `Globals.unprocessed_data` , process it and put it onto the queue `Globals.processed_q`.
 
-Output to `Globals.processed_data should be in the following format:
+Output to `Globals.processed_q` should be in the following format:
 
 input_data = {"current_smartpatch_mac_address": [{"ts": timestamp_in_ms, "values":{"firmwareVersion":
 currentFirmwareVersion, "batteryPercentage": currentBatteryPercentage, "temperature": currentTemperature,
@@ -34,11 +34,18 @@ Not all keys-value pairs have to be in every input_data point.
 __docformat__ = 'google'
 
 # import libraries
+import array
 import time
+from collections import deque
+from dataclasses import dataclass, field
 import numpy as np
-from scipy.fft import fft, fftfreq
-from scipy.signal import butter, filtfilt
-from matplotlib import pyplot as plt
+from scipy.fft import rfft, rfftfreq, next_fast_len
+from scipy.signal import butter, sosfilt
+# matplotlib is an optional extra, the headless basestation only needs it for the debug plots
+try:
+    from matplotlib import pyplot as plt
+except ImportError:
+    plt = None
 import heartpy as hp
 import asyncio
 import logging
@@ -52,20 +59,12 @@ from Basestation import Globals, Settings
 # do not print numpy warnings
 warnings.filterwarnings('ignore')
 
-# data processing variables
-duration = {}
-current_ts = {}
-local_data = {}
-local_imu_raw = {}
-local_imu_converted = {}
-local_ppg = {}
-local_temp = {}
-local_voltage = {}
-local_activity_level = {}
-local_battery_percentage = {}
-
-local_HR = {}
-local_SPO2 = {}
+# processing state of every patient, MAC address -> PatientState
+patient_states = {}
+
+# x axes of the live plots, created once instead of per frame
+PLOT_X_800 = np.arange(800)
+PLOT_X_60 = np.arange(60)
 
 # handles for live plots
 ppg_plot = []
@@ -86,105 +85,207 @@ SAMPLE_DURATION = 20  # Samples are 10s each
 SAMPLE_LENGTH = SAMPLING_FREQUENCY * SAMPLE_DURATION
 SAMPLING_PERIOD = 1.0 / SAMPLING_FREQUENCY
 x = np.linspace(0.0, SAMPLING_PERIOD * SAMPLE_LENGTH, SAMPLE_LENGTH, endpoint=False)
-xf = fftfreq(SAMPLE_LENGTH, SAMPLING_PERIOD)[:SAMPLE_LENGTH // 2]
+NFFT = next_fast_len(SAMPLE_LENGTH)  # transform length rounded up to a composite of fast radices
+xf = rfftfreq(NFFT, SAMPLING_PERIOD)
+
+# bound on the per-address history of derived scalar streams (heart rate, SPO2, temperature, ...)
+STAT_HISTORY_LENGTH = 200
 
 # coefficients for blood oxygen level estimation
 a_coeff = 1.5958422
 b_coeff = -34.6596622
 c_coeff = 112.6898759
 
+# sensitivity at full scale per IMU column, broadcast over rows as an elementwise scale
+IMU_SCALE = np.array([0.0175, 0.0175, 0.0175, 0.000598, 0.000598, 0.000598], dtype=np.float32)
+
+# Butterworth bandpass filters in second-order sections, designed once at module load.
+# The analysis only reads bin magnitudes and peak positions, so a single forward pass is enough
+# and the forward-backward run of filtfilt would double the filtering cost.
+SOS_HR = butter(3, [0.7, 3.5], 'band', fs=SAMPLING_FREQUENCY, output='sos')  # heart rate band, 42 to 210 BPM
+SOS_RR = butter(3, [0.05, 3.5], 'band', fs=SAMPLING_FREQUENCY, output='sos')  # keeps respiration rate as well
+
+# minimum standard deviation of the filtered green channel for heartpy to get a usable signal,
+# below it hp.process would only raise BadSignalWarning after doing its full peak detection
+HEARTPY_QUALITY_MIN_STD = 1.0
+
+
+class RingBuffer:
+    """Fixed-size ring buffer over a preallocated numpy array.
+
+    Appending never reallocates: rows are written at a moving cursor and the oldest rows are
+    overwritten once the capacity is reached. This replaces growing the per-address history
+    with np.append, which copied the entire array on every batch.
+    """
+
+    def __init__(self, capacity, width, dtype=np.float32):
+        self.buf = np.empty((capacity, width), dtype=dtype)
+        self.capacity = capacity
+        self.head = 0  # next write position
+        self.count = 0  # number of valid rows
+
+    def __len__(self):
+        return self.count
+
+    def append(self, block):
+        """Append the rows of block, overwriting the oldest rows when the buffer is full.
+
+        Args:
+            block(numpy.ndarray): rows to append, shaped (n, width)
+        """
+        n = len(block)
+        if n >= self.capacity:
+            # only the newest capacity rows can be kept
+            self.buf[:] = block[-self.capacity:]
+            self.head = 0
+            self.count = self.capacity
+            return
+        first = min(n, self.capacity - self.head)
+        np.copyto(self.buf[self.head:self.head + first], block[:first])
+        if n > first:
+            np.copyto(self.buf[:n - first], block[first:])
+        self.head = (self.head + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+
+    def latest(self, k):
+        """Return the newest min(k, len(self)) rows in chronological order.
+
+        Returns a view into the buffer when the requested range does not wrap around the end,
+        a copy otherwise.
+
+        Args:
+            k(int): number of rows requested
+
+        Returns:
+            numpy.ndarray: the newest rows, shaped (min(k, len(self)), width)
+        """
+        k = min(k, self.count)
+        start = self.head - k
+        if start >= 0:
+            return self.buf[start:self.head]
+        if self.head == 0:
+            return self.buf[start + self.capacity:]
+        return np.concatenate((self.buf[start + self.capacity:], self.buf[:self.head]))
+
+
+@dataclass(slots=True)
+class PatientState:
+    """Complete processing state of one patient.
+
+    One object bundles what used to be a dozen parallel module-level dicts keyed by MAC address,
+    so each pipeline step resolves a single lookup instead of one per stream.
+    """
+
+    ppg: RingBuffer = field(default_factory=lambda: RingBuffer(5000, 3))
+    imu_raw: RingBuffer = field(default_factory=lambda: RingBuffer(2000, 6))
+    imu_converted: np.ndarray = None
+    temp: deque = field(default_factory=lambda: deque(maxlen=STAT_HISTORY_LENGTH))
+    voltage: deque = field(default_factory=lambda: deque(maxlen=STAT_HISTORY_LENGTH))
+    activity_level: deque = field(default_factory=lambda: deque(maxlen=STAT_HISTORY_LENGTH))
+    hr: deque = field(default_factory=lambda: deque(maxlen=STAT_HISTORY_LENGTH))
+    spo2: deque = field(default_factory=lambda: deque(maxlen=STAT_HISTORY_LENGTH))
+    hp_hr: deque = field(default_factory=lambda: deque(maxlen=STAT_HISTORY_LENGTH))
+    hp_rmssd: deque = field(default_factory=lambda: deque(maxlen=STAT_HISTORY_LENGTH))
+    hp_rr: deque = field(default_factory=lambda: deque(maxlen=STAT_HISTORY_LENGTH))
+    battery_percentage: float = 100.0
+    filtered_hr: np.ndarray = None  # filtered green window of the current batch, shared with the debug plots
+    filtered_rr: np.ndarray = None
+    duration: int = 0
+    current_ts: int = 0
+
+
+def get_state(address):
+    """Return the PatientState for address, creating it on first use.
 
-def delete_old_data(address):
-    """ Delete old data stored in local variables if it exceeds the amount needed for processing and plotting.
     Args:
         address(str): MAC address of the Smartpatch
+
+    Returns:
+        PatientState: processing state of the patient wearing that SmartPatch
     """
-    global local_ppg, local_temp, local_imu_raw, local_voltage, local_activity_level, local_imu_converted, \
-        local_HR, local_SPO2
-
-    if len(local_ppg[address]) > 5000:
-        local_ppg[address] = local_ppg[address][4000:]
-    if len(local_imu_raw[address]) > 2000:
-        local_imu_raw[address] = local_imu_raw[address][1000:]
-    if len(local_temp[address]) > 200:
-        local_temp[address] = local_temp[address][100:]
-    if address in local_voltage:
-        if len(local_voltage[address]) > 200:
-            local_voltage[address] = local_voltage[address][100:]
-    if len(local_activity_level[address]) > 200:
-        local_activity_level[address] = local_activity_level[address][100:]
-    if len(local_imu_converted[address]) > 2000:
-        local_imu_converted[address] = local_imu_converted[address][1000:]
-    if len(local_HR[address]) > 200:
-        local_HR[address] = local_HR[address][100:]
-    if len(local_SPO2[address]) > 200:
-        local_SPO2[address] = local_SPO2[address][100:]
-
-
-def split_data(address):
-    """ Separate unprocessed data for further processing.
+    state = patient_states.get(address)
+    if state is None:
+        state = patient_states[address] = PatientState()
+    return state
+
+
+def single_bin_magnitude(signal, k, n=NFFT):
+    """ Return the magnitude of DFT bin k of signal, matching rfft(signal, n)[k].
+
+    Evaluating one bin as a direct inner product is O(len(signal)) and avoids computing a full
+    FFT when only the component at a single known frequency is needed.
+
     Args:
-        address(str): MAC address of the Smartpatch
+        signal(numpy.ndarray): real input signal
+        k(int): index of the requested DFT bin
+        n(int, optional): transform length the bin index refers to (Default value = NFFT)
+
+    Returns:
+        float: magnitude of the requested bin
     """
-    global local_data, local_ppg, local_temp, local_imu_raw, local_voltage
-    for datapoint in local_data:
-        for char, val in datapoint['values'].items():
-
-            if char == 'ppg':
-                if address not in local_ppg:
-                    local_ppg[address] = np.reshape(val, (-1, 3))
-                else:
-                    local_ppg[address] = np.append(local_ppg[address], np.reshape(val, (-1, 3)), 0)
-
-            elif char == 'imu':
-                if address not in local_imu_raw:
-                    local_imu_raw[address] = np.reshape(val, (-1, 6))
-                else:
-                    local_imu_raw[address] = np.append(local_imu_raw[address], np.reshape(val, (-1, 6)), 0)
-
-            elif char == 'temperature':
-                if address not in local_temp:
-                    local_temp[address] = [val[0] / 200.0]
-                else:
-                    local_temp[address].append(val[0] / 200.0)
-
-            elif char == 'voltage':
-                if address not in local_voltage:
-                    local_voltage[address] = [val[0]]
-                else:
-                    local_voltage[address].append(val[0])
-            else:
-                print("unknown datatype received")
-    local_data = {}
+    phasor = np.exp((-2j * np.pi * k / n) * np.arange(len(signal)))
+    return np.abs(signal @ phasor)
 
 
-def write_back(address):
-    """ Write calculated/measured data to Globals.processed_data.
+def split_data(address, data):
+    """ Separate unprocessed data for further processing.
     Args:
         address(str): MAC address of the Smartpatch
+        data(dict): this device's batch, characteristic name -> list of (timestamp, values) pairs
     """
-    global local_voltage, local_imu_converted, local_HR, local_SPO2, local_temp, local_activity_level, \
-        current_ts, hp_RR
-    if address in local_battery_percentage:
-        battery_percentage = local_battery_percentage[address]
-    else:
-        battery_percentage = 100
-
-    sp_data = {"ts": current_ts[address], "values": {"firmwareVersion": 1.23,
-                                                     "batteryPercentage": battery_percentage,
-                                                     "temperature": local_temp[address][-1],
-                                                     "heartrate": local_HR[address][-1], "respirationRate":
-                                                         hp_RR[address][-1],
-                                                     "bloodOxygenation": local_SPO2[address][-1],
-                                                     "activityLevel": local_activity_level[address][-1]}}
-    with Globals.processed_data_lock:
-        if address not in Globals.processed_data:
-            Globals.processed_data[address] = [sp_data]
+    state = get_state(address)
+    for char, samples in data.items():
+        if not samples:
+            continue
+
+        if char == 'ppg':
+            # accumulate the whole batch in one flat array.array, then reinterpret it without a copy
+            acc = array.array('f')
+            for _, values in samples:
+                acc.extend(values)
+            state.ppg.append(np.frombuffer(acc, dtype=np.float32).reshape(-1, 3))
+
+        elif char == 'imu':
+            acc = array.array('f')
+            for _, values in samples:
+                acc.extend(values)
+            state.imu_raw.append(np.frombuffer(acc, dtype=np.float32).reshape(-1, 6))
+
+        elif char == 'temperature':
+            state.temp.extend(values[0] / 200.0 for _, values in samples)
+
+        elif char == 'voltage':
+            state.voltage.extend(values[0] for _, values in samples)
         else:
-            Globals.processed_data[address].append(sp_data)
+            print("unknown datatype received")
 
 
-plt.style.use('ggplot')
+def write_back(address):
+    """ Write calculated/measured data to the processed data queue.
+    Args:
+        address(str): MAC address of the Smartpatch
+    """
+    state = get_state(address)
+    # missing measurements are omitted from the datapoint: Thingsboard rejects null values, so a
+    # NaN placeholder would get the whole datapoint discarded server-side
+    values = {"firmwareVersion": 1.23, "batteryPercentage": state.battery_percentage}
+    if state.temp:
+        values["temperature"] = state.temp[-1]
+    if state.hr:
+        values["heartrate"] = state.hr[-1]
+    if state.hp_rr and not np.isnan(state.hp_rr[-1]):
+        values["respirationRate"] = state.hp_rr[-1]
+    if state.spo2:
+        values["bloodOxygenation"] = state.spo2[-1]
+    if state.activity_level:
+        values["activityLevel"] = state.activity_level[-1]
+    sp_data = {"ts": state.current_ts, "values": values}
+    try:
+        Globals.processed_q.put_nowait((address, sp_data))
+    except asyncio.QueueFull:
+        logging.exception(f"{address}: processed data queue is full, datapoint dropped")
+    # signal the main thread that processed input_data is available
+    Globals.processed_data_ready.set()
 
 
 def live_plotter(address, line1, line2, line3, line4, line5, line6, pause_time=0.1):
@@ -207,12 +308,13 @@ def live_plotter(address, line1, line2, line3, line4, line5, line6, pause_time=0
         line5: Handle for subplot 5
         line6: Handle for subplot 6
     """
-    global local_ppg, local_SPO2, local_HR, local_temp
+    if plt is None:
+        raise RuntimeError("matplotlib is not installed, install the 'plotting' extra to use the debug plots")
 
-    b, a = butter(3, [0.7, 3.5], 'band', fs=100)
-    b2, a2 = butter(3, [0.05, 3.5], 'band', fs=100)
+    state = get_state(address)
 
     if not line1:
+        plt.style.use('ggplot')
         plt.ion()
         fig = plt.figure(figsize=(20, 12))
         ax = fig.add_subplot(321)
@@ -222,12 +324,12 @@ def live_plotter(address, line1, line2, line3, line4, line5, line6, pause_time=0
         ax5 = fig.add_subplot(324)
         ax6 = fig.add_subplot(326)
 
-        line1, = ax.plot(np.arange(0, 800, 1), local_ppg[address][-800:, 2], alpha=0.8)
-        line2, = ax2.plot(np.arange(0, 800, 1), filtfilt(b, a, local_ppg[address][-800:, 2]), alpha=0.8)
-        line3, = ax3.plot(np.arange(0, 800, 1), filtfilt(b2, a2, local_ppg[address][-800:, 2]), alpha=0.8)
-        line4, = ax4.plot(np.arange(0, 60, 1), local_HR[address][-60:], alpha=0.8)
-        line5, = ax5.plot(np.arange(0, 60, 1), local_SPO2[address][-60:], alpha=0.8)
-        line6, = ax6.plot(np.arange(0, 60, 1), local_temp[address][-60:], alpha=0.8)
+        line1, = ax.plot(PLOT_X_800, state.ppg.latest(800)[:, 2], alpha=0.8)
+        line2, = ax2.plot(PLOT_X_800, state.filtered_hr[-800:], alpha=0.8)
+        line3, = ax3.plot(PLOT_X_800, state.filtered_rr[-800:], alpha=0.8)
+        line4, = ax4.plot(PLOT_X_60, list(state.hr)[-60:], alpha=0.8)
+        line5, = ax5.plot(PLOT_X_60, list(state.spo2)[-60:], alpha=0.8)
+        line6, = ax6.plot(PLOT_X_60, list(state.temp)[-60:], alpha=0.8)
 
         ax.set_title("Green PPG channel")
         ax2.set_title("Green PPG channel, filtered for heartrate")
@@ -238,12 +340,12 @@ def live_plotter(address, line1, line2, line3, line4, line5, line6, pause_time=0
 
         plt.show()
 
-    line1.set_ydata(local_ppg[address][-800:, 2])
-    line2.set_ydata(filtfilt(b, a, local_ppg[address][-800:, 2]))
-    line3.set_ydata(filtfilt(b2, a2, local_ppg[address][-800:, 2]))
-    line4.set_ydata(local_HR[address][-60:])
-    line5.set_ydata(local_SPO2[address][-60:])
-    line6.set_ydata(local_temp[address][-60:])
+    line1.set_ydata(state.ppg.latest(800)[:, 2])
+    line2.set_ydata(state.filtered_hr[-800:])
+    line3.set_ydata(state.filtered_rr[-800:])
+    line4.set_ydata(list(state.hr)[-60:])
+    line5.set_ydata(list(state.spo2)[-60:])
+    line6.set_ydata(list(state.temp)[-60:])
 
     for ax in plt.gcf().get_axes():
         ax.relim()
@@ -277,24 +379,23 @@ def print_values(address):
     Args:
         address: MAC address of the Smartpatch
     """
-    global local_voltage, local_imu_converted, local_HR, local_SPO2, local_temp, local_ppg, \
-        local_battery_percentage, local_activity_level
+    state = get_state(address)
 
-    xmx = max(local_imu_converted[address][-120:, 3])
-    xmy = max(local_imu_converted[address][-120:, 4])
-    xmz = max(local_imu_converted[address][-120:, 5])
+    xmx = max(state.imu_converted[-120:, 3])
+    xmy = max(state.imu_converted[-120:, 4])
+    xmz = max(state.imu_converted[-120:, 5])
 
     print('----------------------------' + str(address) + '--------------------------------')
     # fix for missing voltage service
-    if address in local_voltage:
-        print('voltage level: ' + str(local_voltage[address][-1]) + 'mV | Battery life : '
-              + str(local_battery_percentage[address]) + '%')
+    if state.voltage:
+        print('voltage level: ' + str(state.voltage[-1]) + 'mV | Battery life : '
+              + str(state.battery_percentage) + '%')
     print('max acceleration: x:' + str(xmx) + ' y: ' + str(xmy) + ' z ' + str(xmz))
-    print('Heart Rate: (own)' + str(local_HR[address][-1]) + '   (heartpy:)' + str(hp_HR[address][-1]))
-    print('Blood Oxygenation: ' + str(local_SPO2[address][-1]))
-    print('Respiration Rate: ' + str(hp_RR[address][-1]))
-    print('Body Skin Temperature: ' + str(local_temp[address][-1]))
-    print('Activity:' + str(local_activity_level[address][-1]))
+    print('Heart Rate: (own)' + str(state.hr[-1]) + '   (heartpy:)' + str(state.hp_hr[-1]))
+    print('Blood Oxygenation: ' + str(state.spo2[-1]))
+    print('Respiration Rate: ' + str(state.hp_rr[-1]))
+    print('Body Skin Temperature: ' + str(state.temp[-1]))
+    print('Activity:' + str(state.activity_level[-1]))
 
 
 def imu_conversion(address):
@@ -302,28 +403,16 @@ def imu_conversion(address):
     Args:
         address: MAC address of the Smartpatch
     """
-    global local_imu_raw, local_imu_converted, local_activity_level
+    state = get_state(address)
 
     # Convert data into deg*s^-1 and m*s^-2 (multiply sensitivity at full scale and raw value)
-    a = np.array([[0.0175, 0.0175, 0.0175, 0.000598, 0.000598, 0.000598]])
-    conversion_matrix = np.diag(a[0])
-    local_imu_converted[address] = np.matmul(local_imu_raw[address], conversion_matrix)
-
-    xmx = max(local_imu_converted[address][-120:, 3])
-    xmy = max(local_imu_converted[address][-120:, 4])
-    xmz = max(local_imu_converted[address][-120:, 5])
-    abs_xl = np.zeros(120)
-    activity = 0
-    for i in range(120):
-        abs_xl[i] = np.sqrt(local_imu_converted[address][-i, 3] ** 2 + local_imu_converted[address][-i, 4] ** 2 + \
-                            local_imu_converted[address][-i, 5] ** 2)
-    if max(abs_xl) > 12.0:
-        activity = 1
-
-    if address not in local_activity_level:
-        local_activity_level[address] = [activity]
-    else:
-        local_activity_level[address].append(activity)
+    state.imu_converted = state.imu_raw.latest(len(state.imu_raw)) * IMU_SCALE
+
+    # activity is detected when the acceleration magnitude of the last 120 samples exceeds 12 m*s^-2,
+    # compared in squared form over one vectorized pass instead of a per-row Python loop
+    tail = state.imu_converted[-120:, 3:6]
+    activity = 1 if np.einsum('ij,ij->i', tail, tail).max() > 144.0 else 0
+    state.activity_level.append(activity)
 
 
 def ppg_analysis(address):
@@ -331,42 +420,38 @@ def ppg_analysis(address):
     Args:
         address: MAC address of the Smartpatch
     """
-    global local_ppg, a_coeff, b_coeff, c_coeff, x, xf, SAMPLE_LENGTH, SAMPLE_DURATION, SAMPLING_PERIOD, \
-        SAMPLING_FREQUENCY, local_HR, local_SPO2
+    state = get_state(address)
 
     # The PPG channels are filtered between 0.7 Hz and 3.5 Hz (42 to 210 BPM) in order to extract the heart rate
-    b, a = butter(3, [0.7, 3.5], 'band', fs=100)
-    filtered_red = filtfilt(b, a, local_ppg[address][-SAMPLE_LENGTH:, 0])
-    filtered_ir = filtfilt(b, a, local_ppg[address][-SAMPLE_LENGTH:, 1])
-    filtered_green = filtfilt(b, a, local_ppg[address][-SAMPLE_LENGTH:, 2])
+    ppg_tail = state.ppg.latest(SAMPLE_LENGTH)
+    filtered_red = sosfilt(SOS_HR, ppg_tail[:, 0])
+    filtered_ir = sosfilt(SOS_HR, ppg_tail[:, 1])
+    filtered_green = sosfilt(SOS_HR, ppg_tail[:, 2])
+    state.filtered_hr = filtered_green
 
-    # Perform a Fast Fourier Transform to determine heart rate
+    # Perform a real-input Fast Fourier Transform to determine heart rate
     y = filtered_green
-    yf = fft(y)
-    plot_start = int(0.75 * SAMPLE_DURATION)  # between 45 BPM and 210 BPM
-    plot_stop = int(3.5 * SAMPLE_DURATION)
-    a = np.abs(yf[plot_start:plot_stop])  # extract the dominant frequency component
-    hr_index = np.argmax(a) + plot_start
-    if address not in local_HR:  # store the calculated value
-        local_HR[address] = [round(60 * xf[hr_index])]
-    else:
-        local_HR[address].append(round(60 * xf[hr_index]))
+    yf = rfft(y, n=NFFT)
+    plot_start = int(0.75 * NFFT * SAMPLING_PERIOD)  # between 45 BPM and 210 BPM
+    plot_stop = int(3.5 * NFFT * SAMPLING_PERIOD)
+    seg = yf[plot_start:plot_stop]  # extract the dominant frequency component
+    power = seg.real * seg.real + seg.imag * seg.imag  # squared magnitude preserves the argmax, skips the sqrt
+    hr_index = int(np.argmax(power)) + plot_start
+    state.hr.append(round(60 * xf[hr_index]))  # store the calculated value
 
     # Determine AC and DC components of the red and IR channels of the PPG signal
-    ac_red = np.abs(fft(filtered_red))[hr_index]  # The AC component is extracted at the heartrate
-    ac_ir = np.abs(fft(filtered_ir))[hr_index]
-    dc_red = sum(local_ppg[address][-SAMPLE_LENGTH:, 0]) / SAMPLE_LENGTH
-    dc_ir = sum(local_ppg[address][-SAMPLE_LENGTH:, 1]) / SAMPLE_LENGTH
+    # The AC component is extracted at the heartrate, evaluating only that bin instead of a full FFT
+    ac_red = single_bin_magnitude(filtered_red, hr_index)
+    ac_ir = single_bin_magnitude(filtered_ir, hr_index)
+    dc_red = ppg_tail[:, 0].mean()  # builtin sum would iterate the array element-wise in Python
+    dc_ir = ppg_tail[:, 1].mean()
 
     # Calculation based on https://www.maximintegrated.com/en/design/technical-documents/app-notes/6/6845.html
     R = (ac_red / dc_red) / (ac_ir / dc_ir)
     SPO2 = round(a_coeff * (R ** 2) + b_coeff * R + c_coeff)
     if SPO2 > 100:
         SPO2 = 100
-    if address not in local_SPO2:  # store the calculated value
-        local_SPO2[address] = [SPO2]
-    else:
-        local_SPO2[address].append(SPO2)
+    state.spo2.append(SPO2)  # store the calculated value
 
 
 def heartpy_analysis(address):
@@ -374,27 +459,16 @@ def heartpy_analysis(address):
     Args:
         address: MAC address of the Smartpatch
     """
-    global hp_HR, hp_RR, hp_RMSSD
+    state = get_state(address)
     # The filter is chosen such that both the respiration rate and the heartrate retained
-    filtered = hp.filter_signal(local_ppg[address][-2000:, 2], [0.05, 3.5], sample_rate=100.0, order=3,
-                                filtertype='bandpass')
+    filtered = sosfilt(SOS_RR, state.ppg.latest(2000)[:, 2])
+    state.filtered_rr = filtered
 
     working_data, measures = hp.process(filtered, sample_rate=100.0, report_time=False)
 
-    if address not in hp_HR:
-        hp_HR[address] = [measures['bpm']]  # store BPM value
-    else:
-        hp_HR[address].append(measures['bpm'])
-
-    if address not in hp_RMSSD:
-        hp_RMSSD[address] = [measures['rmssd']]  # store RMSSD
-    else:
-        hp_RMSSD[address].append(measures['rmssd'])
-
-    if address not in hp_RR:
-        hp_RR[address] = [measures['breathingrate']]  # store respiration rate
-    else:
-        hp_RR[address].append(measures['breathingrate'])
+    state.hp_hr.append(measures['bpm'])  # store BPM value
+    state.hp_rmssd.append(measures['rmssd'])  # store RMSSD
+    state.hp_rr.append(measures['breathingrate'])  # store respiration rate
 
 
 def calc_battery_percentage(address):
@@ -404,21 +478,76 @@ def calc_battery_percentage(address):
         address: MAC address of the Smartpatch
 
     """
-    global local_voltage, local_battery_percentage
+    state = get_state(address)
     # fix for missing voltage service
-    if address in local_voltage:
-        voltage = local_voltage[address][-1]
+    if state.voltage:
+        voltage = state.voltage[-1]
         if voltage > 3650:
-            local_battery_percentage[address] = 12 + 0.176 * (voltage - 3650)
+            state.battery_percentage = 12 + 0.176 * (voltage - 3650)
         else:
-            local_battery_percentage[address] = 0.0342 * (voltage - 3650)
+            state.battery_percentage = 0.0342 * (voltage - 3650)
+
+
+def analyze_batch(address, per_char):
+    """ Run the compute part of the processing pipeline for one device's batch.
+
+    Executed on a worker thread: numpy, scipy and heartpy release the GIL inside their C kernels,
+    so the batches of different devices genuinely overlap on multi-core hosts. All touched state
+    is keyed per address, batches of distinct devices never share entries.
+
+    Args:
+        address(str): MAC address of the Smartpatch
+        per_char(dict): this device's batch, characteristic name -> list of (timestamp, values) pairs
+    """
+    state = get_state(address)
+    start = min(samples[0][0] for samples in per_char.values() if samples)
+    end = max(samples[-1][0] for samples in per_char.values() if samples)
+    state.duration = end - start
+    state.current_ts = end
+
+    split_data(address, per_char)
+
+    # a batch may lack whole characteristics, e.g. after a failed start_notify call for one
+    # service: only run the analyses whose input buffers actually hold data
+    if len(state.ppg):
+        ppg_analysis(address)
+    if len(state.imu_raw):
+        imu_conversion(address)
+    calc_battery_percentage(address)
+
+    # heartpy is by far the most expensive routine in the pipeline and fails on poor signals anyway:
+    # skip it while the patient is moving or the filtered PPG amplitude is too flat to carry a pulse.
+    # The std is taken over the second half of the window so the filter's startup transient is ignored.
+    moving = bool(state.activity_level) and state.activity_level[-1] == 1
+    if state.filtered_hr is None or moving or \
+            state.filtered_hr[-SAMPLE_LENGTH // 2:].std() < HEARTPY_QUALITY_MIN_STD:
+        state.hp_hr.append(np.nan)
+        state.hp_rmssd.append(np.nan)
+        state.hp_rr.append(np.nan)
+    else:
+        heartpy_analysis(address)
+
+
+async def process_batch(address, per_char):
+    """ Process one device's batch on a worker thread and queue the result.
+
+    The queue is only touched from the event loop thread, after the computation returned.
+
+    Args:
+        address(str): MAC address of the Smartpatch
+        per_char(dict): this device's batch, characteristic name -> list of (timestamp, values) pairs
+    """
+    try:
+        await asyncio.to_thread(analyze_batch, address, per_char)
+        write_back(address)
+    except Exception as e:
+        # one bad batch must not take down the processing task for every other patient
+        logging.exception(f"{address} {e}")
 
 
 async def data_processing():
     """ Executes data processing routine on new data received from all Smartpatches.
     """
-    # i = 1
-
     # wait until enough data has accumulated
     print("Waiting for enough data to start processing..")
     for _ in tqdm(range(30), leave=False):
@@ -427,47 +556,50 @@ async def data_processing():
     while True:
         # check if there is input_data to fetch
         if Globals.unprocessed_data:
-            # take input_data out of unprocessed_data
-            with Globals.unprocessed_data_lock:
-                global local_data, duration, current_ts
-                for address in Globals.unprocessed_data:
-                    start = Globals.unprocessed_data[address][0]['ts']
-                    end = Globals.unprocessed_data[address][-1]['ts']
-                    duration[address] = end - start
-                    current_ts[address] = end
-                    local_data = Globals.unprocessed_data[address]
-                    try:
-                        split_data(address)
-                        ppg_analysis(address)
-                        imu_conversion(address)
-                        calc_battery_percentage(address)
-                        heartpy_analysis(address)
-                        write_back(address)
-                        delete_old_data(address)
-                    except (KeyError, hp.exceptions.BadSignalWarning) as e:
-                        logging.exception(f"{address} {e}")
-
-                    # if i > 60:
-                    #    plots(address)
-                Globals.unprocessed_data = {}
+            batches = []
+            for address in list(Globals.unprocessed_data.keys()):
+                # take this device's input_data out of unprocessed_data, only its own callback is blocked
+                with Globals.unprocessed_data_locks[address]:
+                    per_char = Globals.unprocessed_data.pop(address, None)
+                if per_char:
+                    batches.append((address, per_char))
+
+            # run the batches of different devices concurrently on worker threads
+            if batches:
+                await asyncio.gather(*(process_batch(address, per_char) for address, per_char in batches))
+
+                # debugging output stays fully out of the hot loop unless explicitly enabled
+                if Settings.DEBUG_PLOTS:
+                    for address, _ in batches:
+                        plots(address)
+                        print_values(address)
         await asyncio.sleep(1)
-        # i += 1
 
 
-def no_data_processing():
-    """Unprocessed input_data gets directly passed to processed_data.
+async def no_data_processing():
+    """Unprocessed input_data gets directly passed to the processed data queue.
 
     """
     while True:
         # check if there is input_data to fetch
         if Globals.unprocessed_data:
-            # take input_data out of unprocessed_data
-            with Globals.unprocessed_data_lock:
-                current_data = Globals.unprocessed_data
-                Globals.unprocessed_data = {}
-
-            # save it into processed_data
-            with Globals.processed_data_lock:
-                Globals.processed_data = current_data
-
-        time.sleep(Settings.PROCESSING_DELAY)
+            # take input_data out of unprocessed_data, one device at a time
+            current_data = {}
+            for address in list(Globals.unprocessed_data.keys()):
+                with Globals.unprocessed_data_locks[address]:
+                    per_char = Globals.unprocessed_data.pop(address, None)
+                if per_char:
+                    current_data[address] = per_char
+
+            # pass it on to the processed data queue
+            for address, per_char in current_data.items():
+                for char, samples in per_char.items():
+                    for timestamp, values in samples:
+                        try:
+                            Globals.processed_q.put_nowait((address, {'ts': timestamp, 'values': {char: values}}))
+                        except asyncio.QueueFull:
+                            logging.exception(f"{address}: processed data queue is full, datapoint dropped")
+            # signal the main thread that processed input_data is available
+            Globals.processed_data_ready.set()
+
+        await asyncio.sleep(Settings.PROCESSING_DELAY)
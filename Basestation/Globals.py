@@ -1,19 +1,43 @@
 """Collection of all global variables used in Basestation software"""
 
 # import libraries
+import asyncio
 import threading
+from collections import defaultdict, deque
 
 # addresses of currently connected devices
 connected_devices = {}
 
 # global variables for updates
-mac_address_update = {}
+# pending connection and disconnection requests from the Connector app, both guarded by mac_address_update_lock
+pending_adds = deque()
+pending_removes = set()
+# writers serialize through patient_mapping_lock and swap in a freshly built dict,
+# so readers may read the mapping without the lock and still see a consistent snapshot
 patient_mapping = {}
 smartpatch_config_update = 0
 
 # global variables for passing input_data
+# maps mac address -> characteristic name -> deque of (timestamp, values) pairs
 unprocessed_data = {}
-processed_data = {}
+
+# running per-address receive statistics, guarded by the matching entry of unprocessed_data_locks
+bytes_received = {}
+first_timestamp = {}
+last_timestamp = {}
+
+# queue passing processed datapoints as (mac address, datapoint) pairs from processing to publishing/logging
+processed_q = asyncio.Queue(maxsize=10000)
+
+# event loop running the BLE tasks, set by Ble.ble_loop on startup,
+# needed to signal the connection tasks from other threads
+ble_event_loop = None
+
+# set whenever a connection request is queued, the woken connection tasks drain pending_adds
+add_request_event = asyncio.Event()
+
+# set whenever a disconnection request is queued, wakes the invalid-remove-request check
+remove_request_event = asyncio.Event()
 
 # global locks
 connected_devices_lock = threading.Lock()
@@ -21,5 +45,10 @@ mac_address_update_lock = threading.Lock()
 patient_mapping_lock = threading.Lock()
 config_update_lock = threading.Lock()
 
-unprocessed_data_lock = threading.Lock()
-processed_data_lock = threading.Lock()
+# per-address locks sharding access to the unprocessed_data buffers, created on first use
+unprocessed_data_locks = defaultdict(threading.Lock)
+
+# events signaling the first time a thread has produced data, used for the startup handoff in Basestation.main
+mapping_ready = threading.Event()
+unprocessed_data_ready = threading.Event()
+processed_data_ready = threading.Event()
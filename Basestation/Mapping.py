@@ -9,15 +9,16 @@ __docformat__ = 'google'
 
 # importing libraries
 import logging
+import threading
 from tb_device_mqtt import TBDeviceMqttClient
 from tb_rest_client.rest import ApiException
 from tb_rest_client.rest_client_ce import *
-from tqdm import tqdm
 
 # importing Basestation modules
-from Basestation import Globals, Output, Settings
+from Basestation import Ble, Cache, Globals, Output, RestPool, Settings
 
 
+@Cache.cached(ttl=Settings.CONFIG_CACHE_TTL)
 def get_config(attribute_keys='publishToThingsboard,saveRawData,publishRawData,processData,'
                               'localDataLogging,SmartPatchConfig',
                basestation_name=Settings.BASESTATION_NAME,
@@ -42,23 +43,24 @@ def get_config(attribute_keys='publishToThingsboard,saveRawData,publishRawData,p
 
     """
     configuration = {}
-    with RestClientCE(api_url) as rest_client:
+    rest_client = RestPool.get_client(api_url, username, password)
+    try:
+        basestation = rest_client.get_tenant_device(basestation_name)
         try:
-            rest_client.login(username, password)
-            basestation = rest_client.get_tenant_device(basestation_name)
-            try:
-                response = rest_client.get_attributes(entity_type='DEVICE',
-                                                      entity_id=basestation.id.id,
-                                                      keys=attribute_keys)
-                for attribute in response:
-                    configuration[attribute['key']] = attribute['value']
-
-            except Exception as e:
-                logging.exception(f'{e}: Failed to fetch custom configuration. An attribute was not defined yet.')
-                print(f'No custom Basestation configuration found. Basestation will run with default configuration.')
-                configuration = {}
-        except ApiException as e:
-            logging.exception(e)
+            response = rest_client.get_attributes(entity_type='DEVICE',
+                                                  entity_id=basestation.id.id,
+                                                  keys=attribute_keys)
+            for attribute in response:
+                configuration[attribute['key']] = attribute['value']
+
+        except Exception as e:
+            logging.exception(f'{e}: Failed to fetch custom configuration. An attribute was not defined yet.')
+            print(f'No custom Basestation configuration found. Basestation will run with default configuration.')
+            configuration = {}
+    except ApiException as e:
+        if e.status == 401:  # stale JWT, refresh so the next fetch succeeds
+            RestPool.relogin(username, password)
+        logging.exception(e)
     return configuration
 
 
@@ -87,9 +89,14 @@ def set_new_config(config_dict):
             Globals.smartpatch_config_update = config_dict['SmartPatchConfig']
 
 
+@Cache.cached(ttl=Settings.CONFIG_CACHE_TTL)
 def get_patient_mapping(api_url, username, password, max_patients):
     """Return dict with SmartPatch MAC addresses as keys and assigned patient names as values from Thingsboard database.
 
+    All patient devices and their MAC address attributes are fetched with a single EntityDataQuery
+    instead of one attribute request per device, so the startup cost is one round-trip
+    rather than one per patient.
+
     Args:
       api_url(str): URL of Thingsboard server
       username(str): username for Thingsboard server
@@ -101,24 +108,25 @@ def get_patient_mapping(api_url, username, password, max_patients):
 
     """
     patient_mapping = {}
-    with RestClientCE(api_url) as rest_client:
-        try:
-            rest_client.login(username, password)
-            res = rest_client.get_tenant_devices(page_size=str(max_patients), type='Patient', page=str(0))
-            for patient_data in tqdm(res.data, leave=False, unit='Patient'):
-                # catch exception when patient was not created correctly and therefore has no mac-address
-                try:
-                    response = rest_client.get_attributes(entity_type='DEVICE',
-                                                          entity_id=patient_data.id.id,
-                                                          keys='Mac-Address')
-                    if response:  # check if there is even a MAC Address
-                        if response[0]['value'] != 'disconnected':
-                            patient_mapping[response[0]['value']] = patient_data.name
-
-                except Exception as e:
-                    logging.exception(f'{e}: Problem with fetching initial patient mapping.')
-        except ApiException as e:
-            logging.exception(e)
+    rest_client = RestPool.get_client(api_url, username, password)
+    try:
+        query = EntityDataQuery(
+            entity_filter=DeviceTypeFilter(type='deviceType', device_type='Patient', device_name_filter=''),
+            entity_fields=[EntityKey(type='ENTITY_FIELD', key='name')],
+            latest_values=[EntityKey(type='ATTRIBUTE', key='Mac-Address')],
+            page_link=EntityDataPageLink(page_size=max_patients, page=0))
+        res = rest_client.find_entity_data_by_query(query)
+        for patient_data in res.data:
+            patient_name = patient_data.latest.get('ENTITY_FIELD', {}).get('name')
+            mac_address = patient_data.latest.get('ATTRIBUTE', {}).get('Mac-Address')
+            # patients that were not created correctly have no MAC address attribute
+            if patient_name and mac_address and mac_address.value:
+                if mac_address.value != 'disconnected':
+                    patient_mapping[mac_address.value] = patient_name.value
+    except ApiException as e:
+        if e.status == 401:  # stale JWT, refresh so the next fetch succeeds
+            RestPool.relogin(username, password)
+        logging.exception(e)
     return patient_mapping
 
 
@@ -166,26 +174,30 @@ def smartpatch_config_update(update_content):
 
 
 def disconnect_update(mac_address):
-    """Update globals variables `Globals.patient_mapping` and `Globals.mac_address_update` to indicate that
+    """Update global variables `Globals.patient_mapping` and `Globals.pending_removes` to indicate that
     SmartPatch should get disconnected from Basestation.
 
     Args:
       mac_address(str): MAC address obtained from update message received from callback `on_update`
 
     """
-    # add entry to mac_address_update dict
+    # add entry to the pending disconnection requests
     if mac_address != 'disconnected':  # if device was already disconnected before, there would be no need to remove it
         with Globals.mac_address_update_lock:
-            Globals.mac_address_update[mac_address] = 'remove'
+            Globals.pending_removes.add(mac_address)
+        Ble.signal_remove_request()
 
-    # remove disconnected entry from the patient mapping
+    # remove disconnected entry from the patient mapping.
+    # Writers swap in a freshly built dict so lock-free readers always see a consistent snapshot.
     with Globals.patient_mapping_lock:
         if mac_address in Globals.patient_mapping:
-            Globals.patient_mapping.pop(mac_address)
+            new_mapping = dict(Globals.patient_mapping)
+            new_mapping.pop(mac_address)
+            Globals.patient_mapping = new_mapping
 
 
 def connect_update(patient_name, mac_address):
-    """Update global variables `Globals.patient_mapping` and `Globals.mac_address_update` and cleans up old connections
+    """Update global variables `Globals.patient_mapping` and `Globals.pending_adds` and cleans up old connections
        to indicate that SmartPatch should get connected to Basestation.
 
     Args:
@@ -193,34 +205,52 @@ def connect_update(patient_name, mac_address):
       mac_address(str): MAC address obtained from update message received from callback `on_update`
 
     """
-    # deleting old connections if necessary
-    with Globals.patient_mapping_lock and Globals.mac_address_update_lock:
+    # deleting old connections if necessary.
+    # The former `with lock_a and lock_b:` only acquired lock_b, leaving the patient mapping
+    # unprotected; the mapping and the pending requests are now updated under their own locks,
+    # each held only for its own writes.
+    to_delete = []
+    with Globals.patient_mapping_lock:
+        # the mapping update is prepared on a copy and swapped in with one assignment,
+        # so lock-free readers always see a consistent snapshot
+        new_mapping = dict(Globals.patient_mapping)
 
         # check if the patient was already connected
-        if patient_name in Globals.patient_mapping.values():
+        if patient_name in new_mapping.values():
 
             # gather previous connections
-            to_delete = []
-            for address in Globals.patient_mapping:
-                if Globals.patient_mapping[address] == patient_name:
+            for address in new_mapping:
+                if new_mapping[address] == patient_name:
                     to_delete.append(address)
 
             # delete previous connections
             for previous_address in to_delete:
-                Globals.patient_mapping.pop(previous_address)
-                Globals.mac_address_update[previous_address] = 'remove'
+                new_mapping.pop(previous_address)
 
         # adding/updating entry in patient mapping
-        Globals.patient_mapping[mac_address] = patient_name
-        # adding entry to mac_address_update_dict
-        Globals.mac_address_update[mac_address] = 'add'
+        new_mapping[mac_address] = patient_name
+        Globals.patient_mapping = new_mapping
+
+    with Globals.mac_address_update_lock:
+        # recording the pending disconnection requests for the deleted previous connections
+        Globals.pending_removes.update(to_delete)
+        # adding entry to the pending connection requests
+        Globals.pending_adds.append(mac_address)
+
+    # wake the connection tasks waiting for a new request
+    Ble.signal_connection_request()
+    if to_delete:
+        Ble.signal_remove_request()
+
+    # signal the main thread that a mapping is available
+    Globals.mapping_ready.set()
 
 
 def on_update(_, update, __):
     """Callback when an update from the Connector app is detected on thingsboard server.
     
-    Updates global variables smartpatch_config_update, mac_address_update and patient_mapping according to
-    received update.
+    Updates global variables smartpatch_config_update, pending_adds, pending_removes and patient_mapping
+    according to received update.
 
     Args:
       _: placeholder for callback argument
@@ -229,12 +259,12 @@ def on_update(_, update, __):
 
     """
 
-    # unpacking the received update
-    update_topic = list(update.keys())[0]
-    update_content = list(update.values())[0]
+    # unpacking the received single-entry update without copying its keys and values into lists
+    update_topic, update_content = next(iter(update.items()))
 
     # check for Basestation configuration update
     if update_topic in Settings.BASESTATION_CONFIG_PARAMS_LIST:
+        get_config.cache.invalidate()  # the cached configuration is outdated now
         basestation_config_update(update)
         # if the update is a change to the Basestation configuration, we do not need to see the system state
         return
@@ -242,19 +272,21 @@ def on_update(_, update, __):
     print(f'\nNew update of type: {update_topic}')
     # check for SmartPatch configuration update
     if update_topic == 'SmartPatchConfig':
+        get_config.cache.invalidate()  # the cached configuration is outdated now
         smartpatch_config_update(update_content)
 
     else:
         # dissect update further
-        patient_name = list(update_content.keys())[0]
-        macAddress = list(update_content.values())[0]
+        patient_name, macAddress = next(iter(update_content.items()))
 
         # checks if update is a disconnect
         if update_topic == 'Disconnected':
+            get_patient_mapping.cache.invalidate()  # the cached mapping is outdated now
             disconnect_update(macAddress)
 
         # checks if update is a connect
         elif update_topic == 'Connected':
+            get_patient_mapping.cache.invalidate()  # the cached mapping is outdated now
             connect_update(patient_name, macAddress)
 
         # update could not be assigned
@@ -283,8 +315,10 @@ def get_updates(attribute_list, device_name=Settings.BASESTATION_NAME, callback=
     # subscribing to the different update attributes
     for attribute in attribute_list:
         client.subscribe_to_attribute(key=attribute, callback=callback)
-    while True:
-        sleep(1000)
+
+    # the client handles the network traffic on its own thread, this thread only keeps the
+    # callbacks alive; waiting on a never-set event blocks without any periodic wakeups
+    threading.Event().wait()
 
 
 def configure_basestation():
@@ -294,12 +328,13 @@ def configure_basestation():
     Function is only effective on basestation startup.
 
     """
-    current_configuration = get_config(api_url=Settings.URL, username=Settings.USERNAME, password=Settings.PASSWORD)
+    current_configuration = get_config(api_url=Settings.URL, username=Settings.USERNAME, password=Settings.PASSWORD,
+                                       force_refresh=True)
     set_new_config(current_configuration)
 
 
 def patient_mapping_loop():
-    """Initialize `Globals.mac_address_update` and `Globals.patient_mapping` and update it on new update.
+    """Initialize `Globals.pending_adds` and `Globals.patient_mapping` and update it on new update.
     
        Main function for `Mapping thread`. Apply any new update and then print the updated system state.
        Loop endlessly while waiting for updates.
@@ -312,10 +347,14 @@ def patient_mapping_loop():
                                                           username=Settings.USERNAME,
                                                           password=Settings.PASSWORD,
                                                           max_patients=Settings.MAX_PATIENTS)
-            # creating initial mac_adress_update dict on startup
+            # creating initial pending connection requests on startup
             with Globals.mac_address_update_lock:
                 for macAddress in Globals.patient_mapping:
-                    Globals.mac_address_update[macAddress] = 'add'
+                    Globals.pending_adds.append(macAddress)
+
+            # signal the main thread that the initial mapping is available
+            if Globals.patient_mapping:
+                Globals.mapping_ready.set()
 
         # print the changed state of the system
         Output.show_state()
@@ -0,0 +1,66 @@
+"""
+Pool of long-lived MQTT clients shared by the publishing loops.
+
+Thingsboard identifies a device by the access token used as MQTT username, so one connection is kept
+per access token and reused for all publishes to that device. This avoids paying a fresh TCP and MQTT
+CONNECT round-trip for every published batch.
+"""
+
+# setting the docstring format for the documentation
+__docformat__ = 'google'
+
+# import libraries
+import socket
+import threading
+import paho.mqtt.client as paho
+
+# import Basestation modules
+from Basestation import Settings
+
+# one connected client per Thingsboard access token
+clients = {}
+clients_lock = threading.Lock()
+
+
+def enable_nodelay(client, userdata, sock):
+    """Disable Nagle's algorithm on a freshly opened MQTT socket.
+
+    Registered as on_socket_open so the option is applied again after every automatic reconnect,
+    keeping small telemetry packets from being held back for coalescing.
+
+    Args:
+      client(paho.mqtt.client.Client): the client the socket belongs to
+      userdata: user data as set in the client
+      sock(socket.socket): the newly opened socket
+
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def get_client(access_token, broker=Settings.BROKER, port=Settings.PORT):
+    """Return the long-lived MQTT client for access_token, connecting it on first use.
+
+    The returned client runs its network loop on a background thread and reconnects automatically
+    if the connection drops. Publishing on it is thread-safe, only the pool bookkeeping is locked.
+
+    Args:
+      access_token(str): Thingsboard device access token used as MQTT username
+      broker(str, optional): IP address of Thingsboard server (Default value = Settings.BROKER)
+      port(int, optional): data transfer port of Thingsboard server (Default value = Settings.PORT)
+
+    Returns:
+      paho.mqtt.client.Client: connected client for the given access token
+
+    """
+    with clients_lock:
+        client = clients.get(access_token)
+        if client is None:
+            client = paho.Client()  # create client object
+            client.username_pw_set(access_token)  # access token from thingsboard device
+            client.reconnect_delay_set(min_delay=1, max_delay=32)  # reconnect if the connection drops
+            client.max_inflight_messages_set(64)  # allow pipelined QoS 1 batches instead of one at a time
+            client.on_socket_open = enable_nodelay  # applied to the first and every reconnected socket
+            client.connect(broker, port, keepalive=60)  # establish connection
+            client.loop_start()  # network traffic is handled by a background thread
+            clients[access_token] = client
+    return client
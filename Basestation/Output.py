@@ -4,6 +4,9 @@
 __docformat__ = 'google'
 
 # import libraries
+import logging
+import logging.handlers
+import queue
 from time import sleep
 import art
 import termcolor
@@ -11,6 +14,19 @@ import termcolor
 # import Basestation modules
 from Basestation import Globals, Settings
 
+# state messages are queued here and written by a background listener thread, so the MQTT
+# update callback only enqueues a record instead of blocking on terminal I/O
+console_queue = queue.SimpleQueue()
+console_logger = logging.getLogger('smartpatch.state')
+console_logger.setLevel(logging.INFO)
+console_logger.propagate = False  # keep the console output out of the runtime log file
+console_logger.addHandler(logging.handlers.QueueHandler(console_queue))
+
+stream_handler = logging.StreamHandler()
+stream_handler.setFormatter(logging.Formatter('%(message)s'))
+console_listener = logging.handlers.QueueListener(console_queue, stream_handler)
+console_listener.start()
+
 
 def display_application_title(title):
     """Display the application title as ASCII art over multiple lines.
@@ -36,24 +52,33 @@ def print_bold(text):
 
 
 def show_state():
-    """Print the current values of global variables `Global.smartpatch_config_update`, `Globals.mac_address_update`,
-    and `Globals.patient_mapping`.
+    """Print the current values of global variables `Global.smartpatch_config_update`, `Globals.pending_adds`,
+    `Globals.pending_removes` and `Globals.patient_mapping`.
+
+    The messages go through the queued console logger with %-style arguments, so the repr of
+    the mapping and pending structures is built on the listener thread, not the caller's.
 
     """
 
-    print_bold('\nCurrent System State:')
+    console_logger.info(termcolor.colored('\nCurrent System State:', attrs=['bold']))
     if Globals.patient_mapping:
-        print(f'SmartPatch-Patient-Mapping: {Globals.patient_mapping}')
+        console_logger.info('SmartPatch-Patient-Mapping: %s', Globals.patient_mapping)
     else:
-        print('There are no devices connected at the moment.')
-    if Globals.smartpatch_config_update or Globals.mac_address_update:
-        print_bold('Newest updates to the system state:')
+        console_logger.info('There are no devices connected at the moment.')
+    # copy the pending structures under their lock, the BLE loop mutates them concurrently
+    with Globals.mac_address_update_lock:
+        pending_adds = list(Globals.pending_adds)
+        pending_removes = sorted(Globals.pending_removes)
+    if Globals.smartpatch_config_update or pending_adds or pending_removes:
+        console_logger.info(termcolor.colored('Newest updates to the system state:', attrs=['bold']))
         if Globals.smartpatch_config_update:
-            print(f'SmartPatch-Configuration-Update: {Globals.smartpatch_config_update}')
-        if Globals.mac_address_update:
-            print(f'Connection update: {Globals.mac_address_update}')
+            console_logger.info('SmartPatch-Configuration-Update: %s', Globals.smartpatch_config_update)
+        if pending_adds:
+            console_logger.info('Pending connections: %s', pending_adds)
+        if pending_removes:
+            console_logger.info('Pending disconnections: %s', pending_removes)
     else:
-        print("There were no new updates to the system state.")
+        console_logger.info("There were no new updates to the system state.")
 
 
 def show_configuration():
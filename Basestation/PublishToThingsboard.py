@@ -31,13 +31,15 @@
 __docformat__ = 'google'
 
 # import libraries
+import asyncio
 import logging
-from time import sleep
-import paho.mqtt.client as paho
+import orjson
 from tb_rest_client.rest import ApiException
 
 # import Basestation modules
-from Basestation import Mapping, Globals, Settings
+from Basestation import MqttPool, Globals, Settings
+
+PUBLISH_BATCH_SIZE = 100  # datapoints per MQTT message, keeps payloads well below broker size limits
 
 
 class DataLogger:
@@ -66,87 +68,105 @@ class DataLogger:
             port(str): data transfer port of Thingsboard Server
 
          """
-        self.access_token = list(input_data.keys())[0]
+        # input_data holds a single entry, unpack it without copying keys and values into lists
+        self.access_token, self.data = next(iter(input_data.items()))
         self.broker = broker
         self.port = port
-        self.data = list(input_data.values())[0]
 
-        # initializing mqtt client
-        self.client = paho.Client()  # create client object
-        self.client.username_pw_set(self.access_token)  # access token from thingsboard device
-        self.client.connect(self.broker, self.port, keepalive=60)  # establish connection
+        # fetching the shared long-lived mqtt client for this access token
+        self.client = MqttPool.get_client(self.access_token, broker=self.broker, port=self.port)
 
-    def publish(self, publish_address):
+    def publish(self, publish_address, qos=1):
         """Publish input_data to publish_adress on Thingsboard server.
 
+        Thingsboard accepts JSON arrays of datapoints, so the whole batch is sent as a few
+        array messages instead of one MQTT publish with a forced delay per datapoint. All
+        batches are dispatched back to back and only the last one is awaited, so the broker
+        acknowledgements overlap with the following publishes.
+
         Args:
           publish_address(str): mqtt topic to publish to
+          qos(int, optional): MQTT quality of service level (Default value = 1)
 
         """
-        for datapoint in self.data:
-            response = self.client.publish(publish_address, str(datapoint))
-            sleep(0.002)  # small delay for
-            response.wait_for_publish()  # blocks until  the message is delivered.
+        response = None
+        for start in range(0, len(self.data), PUBLISH_BATCH_SIZE):
+            batch = self.data[start:start + PUBLISH_BATCH_SIZE]
+            # orjson serializes straight to bytes, which paho publishes as-is
+            payload = orjson.dumps(batch, option=orjson.OPT_SERIALIZE_NUMPY)
+            response = self.client.publish(publish_address, payload, qos=qos)
+        if response is not None:
+            response.wait_for_publish()  # blocks until the last dispatched batch is delivered.
+
+    def publish_telemetry(self, qos=1):
+        """Publish telemetry input_data to thingsboard server.
+
+        Args:
+          qos(int, optional): MQTT quality of service level (Default value = 1)
 
-    def publish_telemetry(self):
-        """Publish telemetry input_data to thingsboard server."""
-        self.publish(publish_address='v1/devices/me/telemetry')
+        """
+        self.publish(publish_address='v1/devices/me/telemetry', qos=qos)
 
     def publish_attribute(self):
         """Publish attributes to thingsboard server."""
         self.publish(publish_address='v1/devices/me/attributes')
 
 
-def publishing_loop():
-    """Publish input_data obtained from global dict processed_data to according patient on thingsboard server,
-       and delete input_data that was published from said dict.
+async def publishing_loop():
+    """Publish input_data obtained from the processed data queue to according patient on thingsboard server.
     
-       Main function for `Publishing` thread.
-       In order to adjust the publishing frequency adjust `Settings.PUBLISHING_DELAY`.
-       Make sure it is not slower than the `DataProcessing` Output, otherwise the application will eventually crash.
+       Main coroutine for publishing, runs as a task on the shared Basestation event loop.
+       The coroutine sleeps on the queue until the processing task delivers new datapoints.
 
     """
     print("Started publishing data to Thingsboard server.")
     while True:
-        # check if there is something to publish
-        if not Globals.processed_data:
-            sleep(Settings.PUBLISHING_DELAY)
-        else:
-            # locking the global dict while accessing it
-            with Globals.processed_data_lock:
-                # get processed_data
-                local_data = Globals.processed_data
-                # delete it because it is getting published
-                Globals.processed_data = {}
-            try:
-                # publish the available input_data
-                for macAddress in local_data:
-                    # get the patient accesstoken
-                    accesstoken = Mapping.get_matching_device(macAddress,
-                                                              current_device_mapping=Globals.patient_mapping)
-                    # rebuild the input_data
-                    if accesstoken:  # checking if an accesstoken was found for the current mac-address
-                        assigned_data = {accesstoken: local_data[macAddress]}
-                        # locking the global dict while accessing it
-                        with Globals.connected_devices_lock:
-                            # add a firmware version to input_data if there is one
-                            if macAddress in Globals.connected_devices:
-                                assigned_data[accesstoken].append(
-                                    {"firmwareVersion": Globals.connected_devices[macAddress]})
-
-                        # publish the input_data
-                        logger = DataLogger(input_data=assigned_data)
-                        logger.publish_telemetry()
-
-            except ApiException as exception:
-                logging.exception(exception)
-
-
-def raw_data_publishing_loop():
+        # wait until there is something to publish
+        address, datapoint = await Globals.processed_q.get()
+        local_data = {address: [datapoint]}
+
+        # drain whatever else has accumulated into the same publishing round
+        while not Globals.processed_q.empty():
+            address, datapoint = Globals.processed_q.get_nowait()
+            if address not in local_data:
+                local_data[address] = [datapoint]
+            else:
+                local_data[address].append(datapoint)
+
+        # one consistent snapshot of the patient mapping for this publishing round,
+        # mapping updates swap in a new dict so reading the reference needs no lock
+        mapping_snapshot = Globals.patient_mapping
+
+        try:
+            # publish the available input_data
+            for macAddress in local_data:
+                # get the patient accesstoken
+                accesstoken = mapping_snapshot.get(macAddress)
+                # rebuild the input_data
+                if accesstoken:  # checking if an accesstoken was found for the current mac-address
+                    assigned_data = {accesstoken: local_data[macAddress]}
+                    # locking the global dict while accessing it
+                    with Globals.connected_devices_lock:
+                        # add a firmware version to input_data if there is one
+                        if macAddress in Globals.connected_devices:
+                            assigned_data[accesstoken].append(
+                                {"firmwareVersion": Globals.connected_devices[macAddress]})
+
+                    # publish the input_data
+                    logger = DataLogger(input_data=assigned_data)
+                    logger.publish_telemetry()
+                else:
+                    print(f'No matching patient for {macAddress} found.')
+
+        except ApiException as exception:
+            logging.exception(exception)
+
+
+async def raw_data_publishing_loop():
     """Publish input_data obtained from global dict `Globals.unprocessed_data` to according patient on thingsboard
     server.
 
-       Main function for `RawPublishing` thread.
+       Main coroutine for raw data publishing, runs as a task on the shared Basestation event loop.
        In order to adjust the publishing frequency adjust `Settings.PUBLISHING_DELAY`.
        Make sure it is not faster than the `DataProcessing` Output, otherwise the application will eventually crash.
 
@@ -155,28 +175,53 @@ def raw_data_publishing_loop():
 
     """
     print("Started publishing raw data to Thingsboard server.")
+    # newest already published timestamp per address and characteristic; the buffers are shared
+    # with the processing consumer and cannot be cleared here, so each round only publishes
+    # samples that arrived since the previous one instead of the whole buffer again
+    published_up_to = {}
     while True:
         # check if there is something to publish
         if not Globals.unprocessed_data:
-            sleep(Settings.PUBLISHING_DELAY)
+            await asyncio.sleep(Settings.PUBLISHING_DELAY)
         else:
-            # locking the global dict while accessing it
-            with Globals.unprocessed_data_lock:
-                # get processed_data
-                local_data = Globals.unprocessed_data
+            # copy the new samples one device at a time under their per-address locks
+            local_data = {}
+            for address in list(Globals.unprocessed_data.keys()):
+                with Globals.unprocessed_data_locks[address]:
+                    per_char = Globals.unprocessed_data.get(address)
+                    if not per_char:
+                        continue
+                    fresh = {}
+                    for char, samples in per_char.items():
+                        marker = published_up_to.get((address, char), -1)
+                        new_samples = [sample for sample in samples if sample[0] > marker]
+                        if new_samples:
+                            fresh[char] = new_samples
+                            published_up_to[(address, char)] = new_samples[-1][0]
+                    if fresh:
+                        local_data[address] = fresh
+            # one consistent snapshot of the patient mapping for this publishing round
+            mapping_snapshot = Globals.patient_mapping
+
             try:
                 # publish the available input_data
                 for macAddress in local_data:
                     # get the patient accesstoken
-                    accesstoken = Mapping.get_matching_device(macAddress,
-                                                              current_device_mapping=Globals.patient_mapping)
+                    accesstoken = mapping_snapshot.get(macAddress)
                     # rebuild the input_data
                     if accesstoken:  # checking if an accesstoken was found for the current mac-address
+                        # rebuild datapoints from the per-characteristic buffers
+                        datapoints = [{'ts': timestamp, 'values': {char: values}}
+                                      for char, samples in local_data[macAddress].items()
+                                      for timestamp, values in samples]
                         # choosing the raw input_data device to publish the raw input_data to
-                        assigned_data = {accesstoken + " Raw Data": local_data[macAddress]}
-                        # publish the input_data
+                        assigned_data = {accesstoken + " Raw Data": datapoints}
+                        # publish the input_data; losing the odd raw sample is acceptable
+                        # for the firehose, so skip the QoS 1 acknowledgement round-trips
                         logger = DataLogger(input_data=assigned_data)
-                        logger.publish_telemetry()
+                        logger.publish_telemetry(qos=0)
+                    else:
+                        print(f'No matching patient for {macAddress} found.')
             except ApiException as exception:
                 logging.exception(exception)
-            sleep(1)
+            await asyncio.sleep(1)
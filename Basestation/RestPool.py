@@ -0,0 +1,63 @@
+"""
+Shared authenticated REST client for the Thingsboard API.
+
+Creating a fresh RestClientCE pays a TCP handshake plus a login round-trip on every
+configuration or mapping fetch. One process-wide client is kept logged in instead and
+re-authenticated shortly before its JWT expires, so repeated fetches never pay the
+auth overhead again.
+"""
+
+# setting the docstring format for the documentation
+__docformat__ = 'google'
+
+# import libraries
+import threading
+import time
+from tb_rest_client.rest_client_ce import RestClientCE
+
+# import Basestation modules
+from Basestation import Settings
+
+# the process-wide logged-in client, guarded by client_lock
+client = None
+client_lock = threading.Lock()
+
+TOKEN_REFRESH_MARGIN = 60  # re-login this many seconds before the stored JWT expires
+
+
+def get_client(api_url=Settings.URL, username=Settings.USERNAME, password=Settings.PASSWORD):
+    """Return the shared logged-in REST client, creating and authenticating it on first use.
+
+    The login is renewed shortly before the stored JWT expires, so callers can use the
+    returned client directly without authenticating themselves.
+
+    Args:
+      api_url(str, optional): URL of Thingsboard server (Default value = Settings.URL)
+      username(str, optional): username for Thingsboard server (Default value = Settings.USERNAME)
+      password(str, optional): password for Thingsboard server (Default value = Settings.PASSWORD)
+
+    Returns:
+      RestClientCE: logged-in client for the Thingsboard REST API
+
+    """
+    global client
+    with client_lock:
+        if client is None:
+            client = RestClientCE(api_url)
+        # the client records the exp claim of its JWT on login
+        if time.time() >= (client.token_info.get('exp') or 0) - TOKEN_REFRESH_MARGIN:
+            client.login(username, password)
+    return client
+
+
+def relogin(username=Settings.USERNAME, password=Settings.PASSWORD):
+    """Force a fresh login on the shared client, e.g. after a call failed with HTTP 401.
+
+    Args:
+      username(str, optional): username for Thingsboard server (Default value = Settings.USERNAME)
+      password(str, optional): password for Thingsboard server (Default value = Settings.PASSWORD)
+
+    """
+    with client_lock:
+        if client is not None:
+            client.login(username, password)
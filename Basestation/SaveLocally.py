@@ -1,8 +1,9 @@
 """
 Data logging functionality for creating datasets directly on the Basestation.
 
-Datasets are saved to csv files named with SmartPatch MAC addresses. The module's loggers are only intended as a
-backup logging mechanism and therefore provide no special input_data structure in the output files.
+Datasets are saved as JSON Lines files named with SmartPatch MAC addresses, one JSON entry
+per line. The module's loggers are only intended as a backup logging mechanism and therefore
+provide no special input_data structure in the output files.
 
 """
 
@@ -10,15 +11,49 @@ backup logging mechanism and therefore provide no special input_data structure i
 __docformat__ = 'google'
 
 # import libraries
-import csv
-from time import sleep
+import asyncio
+import atexit
+import orjson
 
 # import Basestation modules
 from Basestation import Globals, Settings
 
+# open log files keyed by file name, kept open across logging rounds
+log_files = {}
+
+
+def get_log_file(file_name):
+    """Return the open log file for file_name, opening it on first use.
+
+    The files are opened in binary append mode with a large buffer, so pre-encoded JSON
+    lines are written without any csv escaping or text codec in between.
+
+    Args:
+      file_name(str): path of the log file
+
+    Returns:
+      the open binary file object
+
+    """
+    log = log_files.get(file_name)
+    if log is None:
+        log = open(file_name, 'ab', buffering=1 << 16)
+        log_files[file_name] = log
+    return log
+
+
+def close_logs():
+    """Flush and close all cached log files, runs at interpreter exit."""
+    for log in log_files.values():
+        log.close()
+    log_files.clear()
+
+
+atexit.register(close_logs)
+
 
 class LocalLogger:
-    """Basic logger that lists input_data for devices in a csv file.
+    """Basic logger that lists input_data for devices in a JSON Lines file.
     
     Data structure should be as explained in Publishing module description.
 
@@ -43,47 +78,55 @@ class LocalLogger:
         self.log_filepath = log_filepath
 
     def write_log(self, mac_address):
-        """Add input_data to log in a new row or create new log file if `self.log_filepath/mac_address.csv` does not
-        exist already.
+        """Add input_data to log as JSON lines or create new log file if `self.log_filepath/mac_address.jsonl`
+        does not exist already.
+
+        The file handle is fetched from the module cache and all entries of this round are
+        encoded with orjson and written with one bulk call instead of reopening the file per entry.
 
         Args:
           mac_address(str): MAC address of a SmartPatch
 
         """
-        # make or open a file with the mac_address as filename
-        file_name = self.log_filepath + mac_address + '.csv'
-        with open(file_name, 'a') as log:
-            writer = csv.DictWriter(log, fieldnames=[mac_address])
-            # write the raw entry from accessing into a row
-            writer.writerow(self.data)
+        # fetch or create the open file with the mac_address as filename
+        file_name = self.log_filepath + mac_address + '.jsonl'
+        log = get_log_file(file_name)
 
+        # write this device's entries of the round in one bulk call, one JSON line per entry
+        values = self.data[mac_address]
+        if not isinstance(values, list):
+            values = [values]
+        log.write(b'\n'.join(orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY) for value in values) + b'\n')
+        log.flush()  # the logs are a backup, keep them current on disk
+
+
+async def local_logging_loop():
+    """Log datapoints from the processed data queue to a JSON Lines file.
 
-def local_logging_loop():
-    """Log `Globals.processed_data` to a csv file and then delete it from `Globals.processed_data`.
-    
     Will be active if Basestation configuration flag `Settings.LOCAL_DATA_LOGGING` is set to `True`.
 
     """
-    print("Start logging input_data to csv..")
+    print("Start logging input_data to JSON Lines files..")
     while True:
-        # check if there is something to publish
-        if not Globals.processed_data:
-            sleep(Settings.PUBLISHING_DELAY)
-        else:
-            # locking the global dict while accessing it
-            with Globals.processed_data_lock:
-                # get processed_data
-                local_data = Globals.processed_data
-                # delete it because it is getting published
-                Globals.processed_data = {}
-
-            # log the available input_data
-            Logger = LocalLogger(local_data, Settings.BACKUP_LOG_PATH)
-            for macAddress in Logger.macAddresses:
-                Logger.write_log(macAddress)
+        # wait until there is something to log
+        address, datapoint = await Globals.processed_q.get()
+        local_data = {address: [datapoint]}
+
+        # drain whatever else has accumulated into the same logging round
+        while not Globals.processed_q.empty():
+            address, datapoint = Globals.processed_q.get_nowait()
+            if address not in local_data:
+                local_data[address] = [datapoint]
+            else:
+                local_data[address].append(datapoint)
+
+        # log the available input_data
+        Logger = LocalLogger(local_data, Settings.BACKUP_LOG_PATH)
+        for macAddress in Logger.macAddresses:
+            Logger.write_log(macAddress)
 
 
-def raw_data_logging_loop():
+async def raw_data_logging_loop():
     """Log raw input_data while simultaneously eiter publishing it to Thingsboard database or saving it locally.
     
     Will be active if Basestation configuration flag `Settings.SAVE_RAW_DATA` is set to `True`.
@@ -93,18 +136,34 @@ def raw_data_logging_loop():
     Process the resulting output before using it.
 
     """
+    # newest already logged timestamp per address and characteristic; the buffers are shared
+    # with the processing consumer and cannot be cleared here, so each round only logs
+    # samples that arrived since the previous one instead of the whole buffer again
+    logged_up_to = {}
     while True:
         # check if there is something to publish
         if not Globals.unprocessed_data:
-            sleep(Settings.PUBLISHING_DELAY)
+            await asyncio.sleep(Settings.PUBLISHING_DELAY)
         else:
-            # locking the global dict while accessing it
-            with Globals.unprocessed_data_lock:
-                # get processed_data
-                local_data = Globals.unprocessed_data
+            # copy the new samples one device at a time under their per-address locks
+            local_data = {}
+            for address in list(Globals.unprocessed_data.keys()):
+                with Globals.unprocessed_data_locks[address]:
+                    per_char = Globals.unprocessed_data.get(address)
+                    if not per_char:
+                        continue
+                    fresh = {}
+                    for char, samples in per_char.items():
+                        marker = logged_up_to.get((address, char), -1)
+                        new_samples = [sample for sample in samples if sample[0] > marker]
+                        if new_samples:
+                            fresh[char] = new_samples
+                            logged_up_to[(address, char)] = new_samples[-1][0]
+                    if fresh:
+                        local_data[address] = fresh
 
             # publish the available input_data
             Logger = LocalLogger(local_data, Settings.RAW_LOG_PATH)
             for macAddress in Logger.macAddresses:
                 Logger.write_log(macAddress)
-        sleep(1)
+        await asyncio.sleep(1)
@@ -31,15 +31,19 @@ PROCESSING_DELAY = 0.05  # time between trying to fetch new data for data proces
 PUBLISHING_DELAY = 0.05  # time between publications to Thingsboard server
 
 MAX_PATIENTS = 100  # maximum number of devices supported
+CONFIG_CACHE_TTL = 300  # seconds fetched configuration and mapping results stay cached
 
 # Settings for BLE
 DEVICE_MAXIMUM = 10  # limit of connectable devices per base station
+MAX_BUFFERED_NOTIFICATIONS = 10000  # per characteristic, oldest unconsumed notifications are dropped beyond this
 
 # Settings for MQTT
-UPDATE_ATTRIBUTES_LIST = ['Connected', 'Disconnected', 'SmartPatchConfig', 'publishToThingsboard', 'saveRawData',
-                          'publishRawData', 'processData', 'localDataLogging', 'SmartPatchConfig']
-BASESTATION_CONFIG_PARAMS_LIST = ['publishToThingsboard', 'saveRawData', 'publishRawData', 'processData',
-                                  'localDataLogging']
+# frozensets: membership checks in the update dispatch are O(1) and duplicates cannot
+# sneak in (the former list subscribed to 'SmartPatchConfig' twice)
+UPDATE_ATTRIBUTES_LIST = frozenset({'Connected', 'Disconnected', 'SmartPatchConfig', 'publishToThingsboard',
+                                    'saveRawData', 'publishRawData', 'processData', 'localDataLogging'})
+BASESTATION_CONFIG_PARAMS_LIST = frozenset({'publishToThingsboard', 'saveRawData', 'publishRawData', 'processData',
+                                            'localDataLogging'})
 # Paths
 LOG_FILE_PATH = 'Logs/'
 BACKUP_LOG_PATH = LOG_FILE_PATH + 'BackupData/'
@@ -52,6 +56,7 @@ PUBLISH_TO_THINGSBOARD = True
 LOCAL_DATA_LOGGING = False  # only gets executed if PUBLISH_TO_THINGSBOARD is set to False
 SAVE_RAW_DATA = False
 PUBLISH_RAW_DATA = False
+DEBUG_PLOTS = False  # enable live plots and value printouts during processing, keep off in production
 
 # Global exception logging configuration
 logging.basicConfig(level=logging.INFO, filename=RUNTIME_LOG_PATH + str(round(time())) + '.log')
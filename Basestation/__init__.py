@@ -4,4 +4,17 @@
 The Basestation Package contains all the functionality needed to run a SmartPatch Basestation. All major threads of
 the main application have their own module. In order to adjust Basestation settings not configurable via the
 Thingsboard UI, change them in `Settings.py`. All global variables used for this application are defined in
-`Globals.py`. Please only access them using their matching thread_lock. """
\ No newline at end of file
+`Globals.py`.
+
+Locking contract for the globals:
+
+- `unprocessed_data` and the per-address receive statistics are sharded by MAC address; take the matching entry of
+  `unprocessed_data_locks` and never a global lock, so devices do not contend with each other.
+- `patient_mapping` is copy-on-write: writers build a new dict under `patient_mapping_lock` and swap it in with one
+  assignment, readers may read the current reference without any lock.
+- `pending_adds` and `pending_removes` are guarded by `mac_address_update_lock`;
+  `connected_devices` by `connected_devices_lock`; `smartpatch_config_update` by `config_update_lock`.
+- One-shot startup flags (`mapping_ready`, `unprocessed_data_ready`, `processed_data_ready`) and the wakeup signals
+  (`add_request_event`, `remove_request_event`) are Events and need no lock.
+- `processed_q` is an asyncio queue owned by the shared event loop; touch it only from coroutines on that loop.
+"""
\ No newline at end of file
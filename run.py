@@ -2,6 +2,14 @@
 Execute this to run the Basestation Software.
 """
 
+# import libraries
+import os
+
+# the processing pipeline already runs one worker thread per device; a BLAS thread pool on
+# top of that oversubscribes the cores, so keep the numerical libraries single-threaded.
+# Must be set before numpy is imported for the first time.
+os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+
 # import Basestation modules
 from Basestation import Basestation
 
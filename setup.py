@@ -9,20 +9,27 @@ setup(
     author='cyrillknecht',
     author_email='',
     description='',
+    # dataclass slots and lazy asyncio primitive binding need 3.10, numpy>=1.26 has no older wheels
+    python_requires='>=3.10',
     install_requires=[
-        'bleak==0.13.0',
+        'bleak>=0.21',
         'art>=5.3',
         'termcolor==1.1.0',
         'tqdm==4.62.3',
         'paho-mqtt==1.6.1',
-        'numpy==1.21.5',
+        'numpy>=1.26,<3',
         'tb-rest-client',
-        'tb-mqtt-client',
+        'tb-mqtt-client>=1.10',
         'heartpy~=1.2.7',
-        'scipy==1.7.3',
-        'matplotlib>=3.3.4',
-        'pytest==7.3.1',
+        'scipy>=1.10',
         'mmh3==4.0.0',
+        'orjson>=3.6',
+        'uvloop>=0.19; platform_system!="Windows"',
         'jwt==1.3.0'
-    ]
+    ],
+    extras_require={
+        # only needed for the live debug plots, the headless basestation runs without it
+        'plotting': ['matplotlib>=3.3.4'],
+        'dev': ['pytest>=7.3']
+    }
 )
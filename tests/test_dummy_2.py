@@ -6,7 +6,7 @@ def test_globals_patient_mapping():
 
 
 def test_globals_processed_data():
-    assert Globals.processed_data == {}
+    assert Globals.processed_q.empty()
 
 
 def test_globals_raw_data():